@@ -0,0 +1,100 @@
+"""
+Startup import cost report for nlp-insights.
+
+Imports text_analytics.app in a child python with -X importtime, from an empty working directory,
+and reports the total import time, the time per top level package and the most expensive modules.
+Engine sdks and FHIR models are imported lazily, so by default the report shows what startup pays;
+--config-types and --resource-types also load what the first config of a type or the first
+resource of a type would, to show the cost that was deferred.
+
+Example:
+  python3 benchmark/import_cost.py
+  python3 benchmark/import_cost.py --config-types acd --resource-types DiagnosticReport,Immunization
+"""
+import argparse
+import collections
+import os
+import subprocess
+import sys
+import tempfile
+
+SERVICE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Resource type -> module of its enhancer
+ENHANCE_MODULES = {"AllergyIntolerance": "text_analytics.enhance.enhance_allergy_intolerance_payload",
+                   "Immunization": "text_analytics.enhance.enhance_immunization_payload",
+                   "DiagnosticReport": "text_analytics.enhance.enhance_diagnostic_report_payload",
+                   "DocumentReference": "text_analytics.enhance.enhance_document_reference_payload"}
+
+
+def child_code(config_types, resource_types):
+    lines = ["import importlib, logging, time",
+             "start = time.perf_counter()",
+             "import text_analytics.app as app",
+             "print('app', time.perf_counter() - start)"]
+    for config_type in config_types:
+        lines.append("start = time.perf_counter()")
+        lines.append("app.get_nlp_service_class(%r)" % config_type)
+        lines.append("print('config type %s', time.perf_counter() - start)" % config_type)
+    for resource_type in resource_types:
+        lines.append("start = time.perf_counter()")
+        lines.append("importlib.import_module(%r)" % ENHANCE_MODULES[resource_type])
+        lines.append("print('resource type %s', time.perf_counter() - start)" % resource_type)
+    return "\n".join(lines)
+
+
+def run_child(config_types, resource_types):
+    """Returns (wall seconds per step, [(module, self us, cumulative us)]) of the imports of the child"""
+    workdir = tempfile.mkdtemp(prefix="nlp-insights-imports-")
+    os.makedirs(os.path.join(workdir, "text_analytics", "configs"))
+    env = dict(os.environ, PYTHONPATH=SERVICE_DIR)
+    for name in ("ACD_ENABLE_CONFIG", "QUICKUMLS_ENABLE_CONFIG"):
+        env.pop(name, None)
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", child_code(config_types, resource_types)],
+                            cwd=workdir, env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr[-2000:])
+    steps = []
+    for line in result.stdout.splitlines():
+        name, _, seconds = line.rpartition(" ")
+        steps.append((name, float(seconds)))
+    modules = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        modules.append((name.strip(), int(self_us), int(cumulative_us)))
+    return steps, modules
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--config-types", default="", help="comma separated config types to load after startup")
+    parser.add_argument("--resource-types", default="", help="comma separated resource types to load after startup")
+    parser.add_argument("--top", type=int, default=20, help="number of packages and modules to list")
+    args = parser.parse_args()
+    config_types = [t for t in args.config_types.split(",") if t]
+    resource_types = [t for t in args.resource_types.split(",") if t]
+
+    steps, modules = run_child(config_types, resource_types)
+
+    print("%-40s %10s" % ("step", "wall ms"))
+    for name, seconds in steps:
+        print("%-40s %10.1f" % (name, seconds * 1000))
+
+    packages = collections.Counter()
+    for name, self_us, cumulative_us in modules:
+        packages[name.split(".")[0]] += self_us
+    print()
+    print("%-40s %10s   (%d modules, %.1f ms)" % ("package", "self ms", len(modules),
+                                                  sum(self_us for name, self_us, cumulative_us in modules) / 1000))
+    for name, self_us in packages.most_common(args.top):
+        print("%-40s %10.1f" % (name, self_us / 1000))
+
+    print()
+    print("%-60s %10s %10s" % ("module", "self ms", "total ms"))
+    for name, self_us, cumulative_us in sorted(modules, key=lambda module: -module[2])[:args.top]:
+        print("%-60s %10.1f %10.1f" % (name, self_us / 1000, cumulative_us / 1000))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,265 @@
+"""
+End to end throughput benchmark for nlp-insights.
+
+Starts the Flask app in a child process against a local stub NLP server (see stub_nlp_servers.py),
+then drives /discoverInsights with the bundles and resources of patientData/bundle.json and the NLP
+fixtures of clinical-enrichment/src/test/resources/Patients, at rising client concurrency.
+
+For every concurrency level it reports the resources enhanced per second, the p50/p95/p99 request
+latency and the peak RSS of the app during the level (where Linux lets the peak be reset), and the
+peak RSS of the whole run.  --output writes the results as json, and --baseline compares
+them with the results of an earlier run: the run fails (exit code 1) when the throughput of a level
+dropped, or its p95 latency grew, by more than --tolerance.
+
+Example:
+  python3 benchmark/run_benchmark.py --nlp quickumls --latency-ms 20 --output baseline.json
+  python3 benchmark/run_benchmark.py --nlp quickumls --latency-ms 20 --baseline baseline.json
+"""
+import argparse
+import glob
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from stub_nlp_servers import StubNLPServer, load_recordings
+
+SERVICE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+REPO_DIR = os.path.dirname(os.path.dirname(SERVICE_DIR))
+WORKLOAD_FILES = [os.path.join(REPO_DIR, "patientData", "bundle.json")] + sorted(
+    glob.glob(os.path.join(REPO_DIR, "clinical-enrichment", "src", "test", "resources", "Patients", "*.json")))
+# Resource types that nlp-insights enhances, counted as the resources of a request
+ENHANCED_TYPES = {"AllergyIntolerance", "Immunization", "DiagnosticReport", "DocumentReference"}
+CONFIG_NAME = "benchmark"
+
+
+def load_workload():
+    """Returns (name, request body, number of resources to enhance) for each bundle or resource with any"""
+    workload = []
+    for path in WORKLOAD_FILES:
+        with open(path) as fh:
+            body = fh.read()
+        fhir_data = json.loads(body)
+        if fhir_data.get("resourceType") == "Bundle":
+            resource_types = [entry["resource"]["resourceType"] for entry in fhir_data.get("entry", [])]
+        else:
+            resource_types = [fhir_data.get("resourceType")]
+        resources = sum(1 for resource_type in resource_types if resource_type in ENHANCED_TYPES)
+        if resources:
+            workload.append((os.path.basename(path), body, resources))
+    return workload
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_app(port, app_env):
+    """Starts the app in a child process, from an empty working directory so no saved configs are loaded"""
+    workdir = tempfile.mkdtemp(prefix="nlp-insights-benchmark-")
+    os.makedirs(os.path.join(workdir, "text_analytics", "configs"))
+    env = dict(os.environ)
+    env.update(FLASK_APP=os.path.join(SERVICE_DIR, "text_analytics", "app.py"), PYTHONPATH=SERVICE_DIR)
+    env.update(app_env)
+    process = subprocess.Popen([sys.executable, "-m", "flask", "run", "--host=127.0.0.1", "--port=%d" % port],
+                               cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    app_url = "http://127.0.0.1:%d" % port
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("nlp-insights exited with code %s" % process.returncode)
+        try:
+            if requests.get(app_url + "/ready", timeout=1).status_code == 200:
+                return process, app_url
+        except requests.ConnectionError:
+            pass
+        time.sleep(0.2)
+    process.kill()
+    raise RuntimeError("nlp-insights did not start")
+
+
+def configure_app(app_url, nlp, stub_url, cache):
+    endpoint = stub_url + ("/match" if nlp == "quickumls" else "/api")
+    config = {"endpoint": endpoint}
+    if nlp == "acd":
+        config.update({"apikey": "", "flow": "benchmark_flow"})
+    definition = {"name": CONFIG_NAME, "nlpServiceType": nlp, "config": config, "cacheEnabled": cache}
+    requests.post(app_url + "/config/definition", data=json.dumps(definition)).raise_for_status()
+    requests.post(app_url + "/config/setDefault", params={"name": CONFIG_NAME}).raise_for_status()
+
+
+def peak_rss_mb(pid):
+    """Returns the peak resident set size of the process in MB, or None where /proc is not available"""
+    try:
+        with open("/proc/%d/status" % pid) as fh:
+            for line in fh:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def reset_peak_rss(pid):
+    """Resets the peak resident set size of the process to its current size, returns whether it could"""
+    try:
+        with open("/proc/%d/clear_refs" % pid, "w") as fh:
+            fh.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def percentile(sorted_values, fraction):
+    """Nearest rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    index = max(int(round(fraction * len(sorted_values) + 0.5)) - 1, 0)
+    return sorted_values[min(index, len(sorted_values) - 1)]
+
+
+def run_level(app_url, workload, concurrency, request_count):
+    """Sends request_count requests, concurrency at a time, cycling through the workload"""
+    sessions = threading.local()
+
+    def send(index):
+        name, body, resources = workload[index % len(workload)]
+        if not hasattr(sessions, "session"):
+            sessions.session = requests.Session()
+        start = time.perf_counter()
+        try:
+            resp = sessions.session.post(app_url + "/discoverInsights", data=body,
+                                         headers={"Content-Type": "application/json"})
+            ok = resp.status_code == 200
+        except requests.RequestException:
+            ok = False
+        return ok, time.perf_counter() - start, resources
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(send, range(request_count)))
+    elapsed = time.perf_counter() - start
+
+    latencies = sorted(latency * 1000 for ok, latency, resources in results if ok)
+    resources = sum(resources for ok, latency, resources in results if ok)
+    return {"concurrency": concurrency,
+            "requests": request_count,
+            "errors": sum(1 for ok, latency, resources in results if not ok),
+            "seconds": round(elapsed, 3),
+            "resourcesPerSecond": round(resources / elapsed, 2),
+            "p50Ms": _round(percentile(latencies, 0.50)),
+            "p95Ms": _round(percentile(latencies, 0.95)),
+            "p99Ms": _round(percentile(latencies, 0.99))}
+
+
+def _round(value):
+    return None if value is None else round(value, 2)
+
+
+def compare_with_baseline(results, baseline, tolerance):
+    """Returns a description of each level that regressed compared to the baseline"""
+    regressions = []
+    baseline_levels = {level["concurrency"]: level for level in baseline["levels"]}
+    for level in results["levels"]:
+        base = baseline_levels.get(level["concurrency"])
+        if base is None:
+            continue
+        if level["resourcesPerSecond"] < base["resourcesPerSecond"] * (1 - tolerance):
+            regressions.append("concurrency %d: %.2f resources/s, baseline %.2f" % (
+                level["concurrency"], level["resourcesPerSecond"], base["resourcesPerSecond"]))
+        if base["p95Ms"] is not None and level["p95Ms"] is not None and \
+                level["p95Ms"] > base["p95Ms"] * (1 + tolerance):
+            regressions.append("concurrency %d: p95 %.2f ms, baseline %.2f ms" % (
+                level["concurrency"], level["p95Ms"], base["p95Ms"]))
+        if level["errors"] > base["errors"]:
+            regressions.append("concurrency %d: %d errors, baseline %d" % (
+                level["concurrency"], level["errors"], base["errors"]))
+    return regressions
+
+
+def print_results(results):
+    print("%11s %8s %6s %12s %9s %9s %9s %9s" % (
+        "concurrency", "requests", "errors", "resources/s", "p50 ms", "p95 ms", "p99 ms", "peak MB"))
+    for level in results["levels"]:
+        print("%11d %8d %6d %12.2f %9s %9s %9s %9s" % (
+            level["concurrency"], level["requests"], level["errors"], level["resourcesPerSecond"],
+            level["p50Ms"], level["p95Ms"], level["p99Ms"],
+            "-" if level["peakRssMb"] is None else "%.1f" % level["peakRssMb"]))
+    if results.get("peakRssMb") is not None:
+        print("peak MB of the run: %.1f" % results["peakRssMb"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--nlp", choices=["quickumls", "acd"], default="quickumls", help="NLP service type to stub")
+    parser.add_argument("--latency-ms", type=float, default=20.0, help="latency of every stub NLP response")
+    parser.add_argument("--jitter-ms", type=float, default=0.0, help="random +/- variation of the stub latency")
+    parser.add_argument("--recordings", help="json file of analyzed text to NLP response body for the stub to replay")
+    parser.add_argument("--concurrency", default="1,2,4,8,16", help="comma separated client concurrency levels")
+    parser.add_argument("--requests", type=int, default=100, help="requests sent at each concurrency level")
+    parser.add_argument("--warmup", type=int, default=10, help="requests sent before measuring")
+    parser.add_argument("--cache", action="store_true", help="enable the NLP response cache of the app")
+    parser.add_argument("--app-env", action="append", default=[], metavar="NAME=VALUE",
+                        help="environment variable for the app, for example NLP_MAX_CONCURRENCY=16")
+    parser.add_argument("--output", help="write the results as json to this file")
+    parser.add_argument("--baseline", help="results json of an earlier run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="allowed relative throughput drop or p95 growth compared to the baseline")
+    args = parser.parse_args()
+
+    workload = load_workload()
+    levels = [int(level) for level in args.concurrency.split(",")]
+    app_env = dict(setting.split("=", 1) for setting in args.app_env)
+
+    stub = StubNLPServer(0, args.latency_ms / 1000, args.jitter_ms / 1000, load_recordings(args.recordings)).start()
+    process, app_url = start_app(free_port(), app_env)
+    try:
+        configure_app(app_url, args.nlp, stub.url, args.cache)
+        run_level(app_url, workload, 1, args.warmup)
+        results = {"settings": {"nlp": args.nlp, "latencyMs": args.latency_ms, "jitterMs": args.jitter_ms,
+                                "requests": args.requests, "cache": args.cache, "appEnv": app_env,
+                                "workload": [name for name, body, resources in workload]},
+                   "levels": []}
+        peaks = []
+        for concurrency in levels:
+            measured = reset_peak_rss(process.pid)  # else the peak is that of the whole run so far
+            level = run_level(app_url, workload, concurrency, args.requests)
+            peak = peak_rss_mb(process.pid)
+            level["peakRssMb"] = _round(peak) if measured else None
+            results["levels"].append(level)
+            if peak is not None:
+                peaks.append(peak)
+        results["peakRssMb"] = _round(max(peaks)) if peaks else None
+        results["nlpCalls"] = stub.calls
+    finally:
+        process.terminate()
+        process.wait()
+        stub.shutdown()
+
+    print_results(results)
+    if args.output:
+        with open(args.output, "w") as fh:
+            json.dump(results, fh, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as fh:
+            regressions = compare_with_baseline(results, json.load(fh), args.tolerance)
+        for regression in regressions:
+            print("REGRESSION " + regression)
+        if regressions:
+            sys.exit(1)
+        print("No regressions compared to %s" % args.baseline)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+"""
+Local stand-ins for the QuickUMLS and ACD services, for benchmarking nlp-insights without real NLP engines.
+
+QuickUMLS answers POST /match, and ACD answers any other POST (the analyze call of a flow).
+Responses are replayed from a recordings file when one is given (json object of analyzed text to
+response body), and are otherwise generated by matching the text against a small vocabulary that
+covers the texts of the test fixtures.  Every response is delayed by the configured latency.
+
+Run on its own:  python3 stub_nlp_servers.py --port 8998 --latency-ms 50
+"""
+import argparse
+import json
+import random
+import re
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# phrase -> (cui, preferred name, UMLS semantic types)
+VOCABULARY = {
+    "pneumonia": ("C0032285", "Pneumonia", ["T047"]),
+    "heart attack": ("C0027051", "Myocardial Infarction", ["T047"]),
+    "penicillin": ("C0030842", "Penicillins", ["T195"]),
+    "diabetes": ("C0011849", "Diabetes Mellitus", ["T047"]),
+    "aortic regurgitation": ("C0003504", "Aortic Valve Insufficiency", ["T047"]),
+    "lung cancer": ("C0242379", "Malignant neoplasm of lung", ["T191"]),
+    "prostate cancer": ("C0600139", "Prostate carcinoma", ["T191"]),
+    "lupron": ("C0085272", "Lupron", ["T121", "T109"]),
+    "hair loss": ("C0002170", "Alopecia", ["T047"]),
+    "muscle pain": ("C0231528", "Myalgia", ["T184"]),
+    "oxycodone": ("C0030049", "oxycodone", ["T121", "T109"]),
+    "allergy": ("C1527304", "Allergic Reaction", ["T046"]),
+    "dtap": ("C0012519", "DTaP vaccine", ["T129"]),
+    "hib": ("C0260408", "Haemophilus influenzae type b vaccine", ["T129"]),
+    "hep a": ("C0376527", "Hepatitis A Vaccines", ["T129"]),
+    "hep b": ("C0062527", "Hepatitis B Vaccines", ["T129"]),
+    "mmr": ("C0065828", "Measles-Mumps-Rubella Vaccine", ["T129"]),
+    "influenza": ("C0021400", "Influenza", ["T047"]),
+    "ipv": ("C0032375", "Poliovirus Vaccine, Inactivated", ["T129"]),
+    "rotavirus": ("C0796432", "Rotavirus vaccine", ["T129"]),
+    "varicella": ("C0042313", "Chickenpox Vaccine", ["T129"]),
+    "pneumococcal": ("C0032604", "Pneumococcal Vaccines", ["T129"]),
+    "vaccine": ("C0042210", "Vaccines", ["T129"]),
+}
+
+# UMLS semantic type -> ACD concept type
+ACD_TYPES = {
+    "T046": "umls.PathologicFunction",
+    "T047": "umls.DiseaseOrSyndrome",
+    "T109": "umls.OrganicChemical",
+    "T121": "umls.PharmacologicSubstance",
+    "T129": "umls.ImmunologicFactor",
+    "T184": "umls.SignOrSymptom",
+    "T191": "umls.NeoplasticProcess",
+    "T195": "umls.Antibiotic",
+}
+
+_PHRASES = re.compile("|".join(r"\b%s\b" % re.escape(phrase) for phrase in
+                               sorted(VOCABULARY, key=len, reverse=True)), re.IGNORECASE)
+
+
+def match_concepts(text):
+    """Returns (begin, end, covered text, cui, preferred name, semantic types) for each vocabulary match"""
+    return [(m.start(), m.end(), m.group(0)) + VOCABULARY[m.group(0).lower()] for m in _PHRASES.finditer(text)]
+
+
+def quickumls_response(text):
+    return [{"cui": cui, "term": name, "ngram": covered, "start": begin, "end": end,
+             "semtypes": semtypes, "similarity": 1.0}
+            for begin, end, covered, cui, name, semtypes in match_concepts(text)]
+
+
+def acd_response(text):
+    concepts = [{"cui": cui, "preferredName": name, "type": ",".join(ACD_TYPES[s] for s in semtypes),
+                 "begin": begin, "end": end, "coveredText": covered, "source": "umls",
+                 "snomedConceptId": str(100000 + int(cui[1:]) % 900000)}
+                for begin, end, covered, cui, name, semtypes in match_concepts(text)]
+    data = {"concepts": concepts, "attributeValues": [],
+            "sentences": [{"begin": 0, "end": len(text), "coveredText": text, "uid": 1}]}
+    return {"unstructured": [{"data": data}]}
+
+
+class StubNLPServer(ThreadingHTTPServer):
+    """HTTP server answering both QuickUMLS and ACD calls, with a fixed latency and optional jitter"""
+
+    daemon_threads = True
+
+    def __init__(self, port=0, latency=0.0, jitter=0.0, recordings=None):
+        super().__init__(("127.0.0.1", port), _StubHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.recordings = recordings or {}
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%d" % self.server_address[1]
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name="stub-nlp-server", daemon=True).start()
+        return self
+
+    def respond(self, path, body):
+        with self._lock:
+            self.calls += 1
+        time.sleep(max(self.latency + random.uniform(-self.jitter, self.jitter), 0))
+        if path.startswith("/match"):
+            text = json.loads(body)["text"]
+            return self.recordings.get(text) or quickumls_response(text)
+        text = body.decode("utf-8")  # the ACD sdk posts the text as the body
+        return self.recordings.get(text) or acd_response(text)
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, like the real services
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        out = json.dumps(self.server.respond(self.path, body)).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(out)))
+        self.end_headers()
+        self.wfile.write(out)
+
+
+def load_recordings(path):
+    if path is None:
+        return {}
+    with open(path) as fh:
+        return json.load(fh)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8998)
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="delay of every response")
+    parser.add_argument("--jitter-ms", type=float, default=0.0, help="random +/- variation of the delay")
+    parser.add_argument("--recordings", help="json file of analyzed text to response body to replay")
+    args = parser.parse_args()
+    server = StubNLPServer(args.port, args.latency_ms / 1000, args.jitter_ms / 1000, load_recordings(args.recordings))
+    print("Stub NLP server on %s (QuickUMLS: %s/match, ACD: %s/api)" % (server.url, server.url, server.url))
+    server.serve_forever()
@@ -0,0 +1,13 @@
+# Production server settings, read by gunicorn:  gunicorn --config gunicorn.conf.py text_analytics.app:app
+# Every worker process loads the app on its own (no preload), restores the configs from the shared
+# config directory and then follows the config changes made through the other workers.
+# The docker image gets this file through the copySpec in build.gradle; without it gunicorn would bind
+# 127.0.0.1:8000 with one sync worker.
+import os
+
+bind = "0.0.0.0:" + os.getenv("PORT", "5000")
+workers = int(os.getenv("NLP_WORKERS", "1"))
+worker_class = "gthread"
+threads = int(os.getenv("NLP_WORKER_THREADS", "16"))
+# Large bundles and documents can take a while to enhance
+timeout = int(os.getenv("NLP_WORKER_TIMEOUT", "300"))
@@ -1,9 +1,169 @@
+import asyncio
+import contextvars
+import functools
+import hashlib
+import json
 from abc import ABC, abstractmethod
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from text_analytics import nlp_chunking
+from text_analytics import nlp_deadline
+from text_analytics import nlp_guard
+from text_analytics import nlp_metrics
+from text_analytics.insights.concept_records import NLPResponse
+from text_analytics.nlp_cache import response_cache
 
 
 class NLPService(ABC):
+    # Default number of concurrent connections to the NLP engine
+    pool_size = 8
+    # Encodings of the insight evidence of a request, set on the PlannedNLPService of the request
+    # (see fhir_object_utils.encode_insight_detail); a service is shared by all requests, so it keeps none
+    evidence_encodings = None
+
+    def __init__(self, json_string):
+        config_dict = json.loads(json_string)
+        self.jsonString = json_string
+        self.config_name = config_dict["name"]
+        # Any change to the config gives its responses new cache keys
+        self.config_version = hashlib.sha256(json_string.encode('utf-8')).hexdigest()[:16]
+        self.cache_enabled = config_dict.get("cacheEnabled", True)
+        details = config_dict.get("config") or {}
+        if details.get("poolSize") is not None:
+            self.pool_size = max(int(details["poolSize"]), 1)
+        # Longer texts are split into chunks that are analyzed concurrently (0 never splits)
+        self.chunk_size = int(details.get("chunkSize", nlp_chunking.default_chunk_size))
+        self.chunk_overlap = max(int(details.get("chunkOverlap", nlp_chunking.default_chunk_overlap)), 0)
+        # Calls to the engine are limited to fewer than pool_size at once while it slows down, and fail
+        # fast while it keeps failing; they then go to the fallback config, if there is one
+        latency_target_ms = float(details.get("latencyTargetMs", nlp_guard.default_latency_target_ms))
+        self.guard = nlp_guard.BackendGuard(
+            self.pool_size, latency_target_ms / 1000 if latency_target_ms > 0 else None,
+            float(details.get("limitWaitSeconds", nlp_guard.default_limit_wait_seconds)),
+            int(details.get("breakerFailures", nlp_guard.default_breaker_failures)),
+            float(details.get("breakerOpenSeconds", nlp_guard.default_breaker_open_seconds)))
+        self.fallback_config = config_dict.get("fallbackConfig")
+        # The engine clients block, so async calls run on threads - one per connection.
+        # The threads exit once this service is closed (replaced or deleted) and done with the calls it has.
+        self.executor = ThreadPoolExecutor(max_workers=self.pool_size, thread_name_prefix="nlp-" + self.config_name)
+
+    def process(self, text, use_fallback=True, config=None):
+        """
+        Returns the NLP response for the text (an NLPResponse, which carries the concept records the
+        insights are built from), from the response cache if enabled for this config.
+        Texts longer than chunk_size are analyzed in chunks and their responses merged.
+        While the engine is unavailable (see nlp_guard) the text is analyzed by the fallback config,
+        if there is one and use_fallback is set; it is looked up in config, the config snapshot
+        (see nlp_config) of the request, so without one there is no fallback.
+        """
+        if 0 < self.chunk_size < len(text):
+            return self._process_chunked(text.decode('utf-8') if isinstance(text, bytes) else text, use_fallback,
+                                         config)
+        return self._process_text(text, use_fallback, config)
+
+    def _process_text(self, text, use_fallback=True, config=None):
+        try:
+            if not self.cache_enabled:
+                return self._measured_analyze(text)
+            key = response_cache.make_key(self.config_name, self.config_version, text)
+            return response_cache.get_or_load(key, lambda: self._measured_analyze(text))
+        except nlp_deadline.DeadlineExceeded:
+            raise
+        except Exception as ex:
+            # fail over when the call failed fast, or when its failure opened the breaker
+            unavailable = isinstance(ex, nlp_guard.BackendUnavailable) or self.guard.breaker.state == nlp_guard.OPEN
+            fallback = self._fallback_service(config) if use_fallback and unavailable else None
+            if fallback is None:
+                raise
+            nlp_metrics.backend_fallbacks.inc(config=self.config_name)
+            return fallback.process(text, use_fallback=False)  # no fallback of the fallback, so no loops
+
+    def _fallback_service(self, config):
+        if self.fallback_config is None or config is None:
+            return None
+        return config.services.get(self.fallback_config)
+
+    def _submit(self, func, *args):
+        """Runs func(*args) on the engine threads, or right away on this thread once the service is closed"""
+        try:
+            return self.executor.submit(contextvars.copy_context().run, func, *args)
+        except RuntimeError:  # closed while a request that started with this service still uses it
+            future = Future()
+            try:
+                future.set_result(func(*args))
+            except Exception as ex:
+                future.set_exception(ex)
+            return future
+
+    def _process_chunked(self, text, use_fallback=True, config=None):
+        chunks = nlp_chunking.split_text(text, self.chunk_size, self.chunk_overlap)
+        nlp_metrics.text_chunks.inc(len(chunks), config=self.config_name)
+        # The other chunks are analyzed on the engine threads while this thread analyzes the first one,
+        # then this thread takes back the chunks that no engine thread has started yet.  So it never
+        # waits on queued work, even when it is itself one of the engine threads.
+        futures = [self._submit(self._process_text, chunk, use_fallback, config) for offset, chunk in chunks[1:]]
+        responses = [self._process_text(chunks[0][1], use_fallback, config)]
+        for future, (offset, chunk) in zip(futures, chunks[1:]):
+            responses.append(self._process_text(chunk, use_fallback, config) if future.cancel() else future.result())
+        return NLPResponse(nlp_chunking.merge_responses(chunks, responses))
+
+    def _measured_analyze(self, text):
+        try:
+            nlp_deadline.check()
+            return NLPResponse(self.guard.call(self._timed_analyze, text))
+        except nlp_deadline.DeadlineExceeded:
+            raise
+        except nlp_guard.BackendUnavailable:
+            nlp_metrics.backend_rejected.inc(config=self.config_name)
+            raise
+        except Exception:
+            nlp_metrics.backend_errors.inc(config=self.config_name)
+            raise
+
+    def _timed_analyze(self, text):
+        with nlp_metrics.nlp_call_seconds.time(config=self.config_name):
+            return self.analyze(text)
+
+    async def process_async(self, text, config=None):
+        """Awaitable version of process(); many texts can be analyzed concurrently on one event loop"""
+        loop = asyncio.get_running_loop()
+        call = functools.partial(contextvars.copy_context().run, self.process, text, True, config)
+        try:
+            future = loop.run_in_executor(self.executor, call)
+        except RuntimeError:  # closed while a request that started with this service still uses it
+            future = loop.run_in_executor(None, call)
+        return await future
+
+    async def process_many_async(self, texts, config=None):
+        """Analyzes the texts concurrently and returns their responses in the same order"""
+        return list(await asyncio.gather(*[self.process_async(text, config) for text in texts]))
+
+    def process_many(self, texts, config=None):
+        """
+        Blocking version of process_many_async(), so an enhancer can send all the texts of a resource at once.
+        Must not be called from a running event loop (use process_many_async() there).
+        """
+        if len(texts) <= 1:
+            return [self.process(text, config=config) for text in texts]
+        return asyncio.run(self.process_many_async(texts, config))
+
+    def warm_up(self):
+        """Sets up what the first call to the NLP engine would otherwise wait for (connections, tokens)"""
+        pass
+
+    def close(self):
+        """Releases background resources when the config is replaced or deleted"""
+        self.executor.shutdown(wait=False)
+
+    def stats(self):
+        """Returns statistics about the connections to the NLP engine"""
+        return {}
+
+    def guard_stats(self):
+        """Returns the state of the concurrency limiter and circuit breaker of the calls to the NLP engine"""
+        return dict(self.guard.stats(), fallbackConfig=self.fallback_config)
 
     @abstractmethod
-    def process(self, text):
+    def analyze(self, text):
+        """Calls the NLP engine and returns its response for the text"""
         return None
-
@@ -0,0 +1,98 @@
+import logging
+import queue
+import threading
+
+from ibm_cloud_sdk_core.authenticators.iam_authenticator import IAMAuthenticator
+from ibm_cloud_sdk_core.authenticators.no_auth_authenticator import NoAuthAuthenticator
+from ibm_whcs_sdk import annotator_for_clinical_data as acd
+
+logger = logging.getLogger()
+
+# Seconds between checks whether the IAM token is due for a refresh, so a request rarely finds it due
+TOKEN_CHECK_INTERVAL = 10
+# Wait before trying again when a token request fails
+TOKEN_RETRY_INTERVAL = 10
+
+
+class ACDClientPool:
+    """
+    Pool of long lived ACD clients for one ACD config.
+
+    Each client keeps its own keep-alive HTTP session.  All clients share one authenticator, and
+    for IAM api keys a background thread fetches the first token right away and then refreshes it
+    before it expires, so requests never wait on the IAM endpoint.
+    """
+
+    def __init__(self, apikey, url, version, size):
+        if apikey is None or len(apikey) == 0:
+            self.authenticator = NoAuthAuthenticator()
+        else:
+            self.authenticator = IAMAuthenticator(apikey=apikey)
+        self.url = url
+        self.version = version
+        self.size = max(size, 1)
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._refresher = None
+        if isinstance(self.authenticator, IAMAuthenticator):
+            self._refresher = threading.Thread(target=self._refresh_token_loop, name="acd-token-refresh", daemon=True)
+            self._refresher.start()
+
+    def _new_client(self):
+        client = acd.AnnotatorForClinicalDataV1(
+            authenticator=self.authenticator,
+            version=self.version
+        )
+        client.set_service_url(self.url)
+        return client
+
+    def acquire(self):
+        """Returns an idle client, creating one if the pool is not full yet, else waits for one"""
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            can_create = self._created < self.size
+            if can_create:
+                self._created += 1
+        if can_create:
+            try:
+                return self._new_client()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+        return self._idle.get()
+
+    def release(self, client):
+        self._idle.put(client)
+
+    def warm_up(self):
+        """Creates all the clients of the pool and waits for the first IAM token"""
+        clients = [self.acquire() for _ in range(self.size - self._created + self._idle.qsize())]
+        for client in clients:
+            self.release(client)
+        if isinstance(self.authenticator, IAMAuthenticator):
+            self.authenticator.token_manager.get_token()
+
+    def close(self):
+        """Stops refreshing the token; clients already handed out keep working"""
+        self._closed.set()
+
+    def stats(self):
+        return {"poolSize": self.size, "clients": self._created, "idleClients": self._idle.qsize()}
+
+    def _refresh_token_loop(self):
+        # get_token() fetches the token when there is none or it expired, and refreshes it once it is due
+        token_manager = self.authenticator.token_manager
+        while not self._closed.is_set():
+            try:
+                token_manager.get_token()
+                wait = TOKEN_CHECK_INTERVAL
+            except Exception:
+                logger.exception("Error refreshing ACD IAM token")
+                wait = TOKEN_RETRY_INTERVAL
+            self._closed.wait(wait)
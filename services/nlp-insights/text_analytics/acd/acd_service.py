@@ -8,11 +8,10 @@ from fhir.resources.extension import Extension
 from fhir.resources.medicationstatement import MedicationStatement
 from fhir.resources.quantity import Quantity
 from fhir.resources.timing import Timing
-from ibm_cloud_sdk_core.authenticators.iam_authenticator import IAMAuthenticator
-from ibm_cloud_sdk_core.authenticators.no_auth_authenticator import NoAuthAuthenticator
-from ibm_whcs_sdk import annotator_for_clinical_data as acd
 
+from text_analytics import nlp_deadline
 from text_analytics.abstract_nlp_service import NLPService
+from text_analytics.acd.acd_client_pool import ACDClientPool
 from text_analytics.enhance import *
 from text_analytics.insights import insight_constants
 from text_analytics.insights.add_insights_medication import create_insight
@@ -32,33 +31,40 @@ class ACDService(NLPService):
     PROCESS_TYPE_STRUCTURED = "ACD Structured"
 
     version = "2021-01-01"
+    # Seconds an ACD call may take (the default of the sdk), less when the request deadline is closer
+    timeout = 60
 
     def __init__(self, json_string):
+        super().__init__(json_string)
         config_dict = json.loads(json_string)
         self.acd_key = config_dict["config"]["apikey"]
         self.acd_url = config_dict["config"]["endpoint"]
         self.acd_flow = config_dict["config"]["flow"]
-        self.config_name = config_dict["name"]
-        self.jsonString = json_string
-        config_dict = json.loads(json_string)
         if config_dict.get('version') is not None:
             self.version = config_dict.get('version')
+        self.client_pool = ACDClientPool(self.acd_key, self.acd_url, self.version, self.pool_size)
+
+    def warm_up(self):
+        self.client_pool.warm_up()
+
+    def close(self):
+        super().close()
+        self.client_pool.close()
+
+    def stats(self):
+        return self.client_pool.stats()
 
-    def process(self, text):
-        if self.acd_key is None or len(self.acd_key) == 0:
-            authenticator = NoAuthAuthenticator()
-        else:
-            authenticator = IAMAuthenticator(apikey=self.acd_key)
-        service = acd.AnnotatorForClinicalDataV1(
-            authenticator=authenticator,
-            version=self.version
-        )
-        service.set_service_url(self.acd_url)
+    def analyze(self, text):
         logger.info("Calling ACD-" + self.config_name)
-        # resp = service.analyze_with_flow(self.acd_flow, text)
-        # out = resp.to_dict()
-        # TODONOW: service.analyze_with_flow doesn't return sentences, lines, paragraphs
-        resp = service.analyze_with_flow_org(self.acd_flow, text)
+        service = self.client_pool.acquire()
+        try:
+            service.http_config = {'timeout': nlp_deadline.timeout(self.timeout)}
+            # resp = service.analyze_with_flow(self.acd_flow, text)
+            # out = resp.to_dict()
+            # TODONOW: service.analyze_with_flow doesn't return sentences, lines, paragraphs
+            resp = service.analyze_with_flow_org(self.acd_flow, text)
+        finally:
+            self.client_pool.release(service)
         out = resp.result['unstructured'][0]['data']
 
         # Do a little work to flesh out sentence covered texts
@@ -72,13 +78,14 @@ class ACDService(NLPService):
         medications = nlp_output.get('MedicationInd', [])
         med_statements_found = {}
         med_statements_insight_counter = {}
+        coding_indexes = {}
         for medication in medications:
-            med_statements_found, med_statements_insight_counter = create_insight(medication, nlp, nlp_output, diagnostic_report, ACDService.build_medication, med_statements_found, med_statements_insight_counter, span_to_medref)
+            med_statements_found, med_statements_insight_counter = create_insight(medication, nlp, nlp_output, diagnostic_report, ACDService.build_medication, med_statements_found, med_statements_insight_counter, span_to_medref, coding_indexes)
 
         return med_statements_found, med_statements_insight_counter
 
     @staticmethod
-    def build_medication(med_statement, medication, insight_id):
+    def build_medication(med_statement, medication, insight_id, codings=None):
         if med_statement.status is None:
             med_statement.status = 'unknown'
 
@@ -92,7 +99,7 @@ class ACDService(NLPService):
             med_statement.medicationCodeableConcept = codeable_concept
             codeable_concept.coding = []
 
-        fhir_object_utils.add_codings_drug(acd_drug, acd_drug_name, med_statement.medicationCodeableConcept, insight_id, insight_constants.INSIGHT_ID_UNSTRUCTURED_SYSTEM)
+        fhir_object_utils.add_codings_drug(acd_drug, acd_drug_name, med_statement.medicationCodeableConcept, insight_id, insight_constants.INSIGHT_ID_UNSTRUCTURED_SYSTEM, codings)
 
         if hasattr(medication, "administration"):
             if med_statement.dosage is None:
@@ -1,25 +1,58 @@
+import contextlib
+import contextvars
+import importlib
 import json
 import logging
 import os
-
-from flask import Flask, request, Response
-
-from text_analytics.acd.acd_service import ACDService
-from text_analytics.quickUMLS.quickUMLS_service import QuickUMLSService
+import threading
+import time
+import zlib
+
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, request, Response, stream_with_context
+
+from text_analytics import nlp_deadline
+from text_analytics import nlp_jobs
+from text_analytics import nlp_kafka
+from text_analytics import nlp_metrics
+from text_analytics.config_store import ConfigStore
+from text_analytics.enhance import enhance_to_dict
+from text_analytics.insights.insight_fingerprint import get_fingerprint, resource_fingerprint, set_fingerprint
+from text_analytics.nlp_cache import response_cache
+from text_analytics.nlp_config import NLPConfigHolder
+from text_analytics.nlp_plan import PlannedNLPService, plan_texts
+from text_analytics.utils import compression
+from text_analytics.utils import fast_json
 
 logger = logging.getLogger()
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s %(levelname)s %(name)s %(threadName)s : %(message)s')
 
 app = Flask(__name__)
 
-# Maps values seen in configs to NLP python classes
-all_nlp_services = {'acd': ACDService, 'quickumls': QuickUMLSService}
-# NLP Service currently configured
-nlp_service = None
-# Stores instances of configured NLP Services
-nlp_services_dict = {}
-# Stores resource to config overrides
-override_resource_config = {}
+# Maps values seen in configs to NLP python classes, imported when a config of the type is first created
+all_nlp_services = {'acd': 'text_analytics.acd.acd_service.ACDService',
+                    'quickumls': 'text_analytics.quickUMLS.quickUMLS_service.QuickUMLSService',
+                    'dictionary': 'text_analytics.dictionary.dictionary_service.DictionaryService'}
+# Snapshot of the configured NLP services, default config and resource to config overrides
+nlp_config = NLPConfigHolder()
+# Max number of resources enhanced at the same time across all requests
+max_concurrency = int(os.getenv("NLP_MAX_CONCURRENCY", "8"))
+# Default max number of resources enhanced at the same time for a single bundle
+request_concurrency = int(os.getenv("NLP_REQUEST_CONCURRENCY", str(max_concurrency)))
+# Number of NDJSON records enhanced together when streaming
+ndjson_batch_size = int(os.getenv("NLP_NDJSON_BATCH_SIZE", "32"))
+# Parse and validate every resource as a whole, instead of reading only the fields that get insights
+strict_validation = os.getenv("NLP_STRICT_VALIDATION", "false") == 'true'
+# Resources already enhanced by this process version from the same texts and config are returned as is
+incremental_mode = os.getenv("NLP_INCREMENTAL", "false") == 'true'
+# Errors decompressing a request body, answered by decompression_error_response
+DECOMPRESSION_ERRORS = (compression.UnsupportedEncoding, compression.TooLarge, zlib.error)
+# Worker pool shared by all requests for enhancing bundle entries
+bundle_executor = ThreadPoolExecutor(max_workers=max(max_concurrency, 1), thread_name_prefix="nlp-worker")
+# Seconds between checks for config changes made by other worker processes
+config_sync_seconds = float(os.getenv("NLP_CONFIG_SYNC_SECONDS", "2"))
+# Set once the configs restored at startup are warmed up
+ready = threading.Event()
 
 
 def setup_config_dir():
@@ -31,7 +64,16 @@ def setup_config_dir():
 
 def persist_config_helper(config_dict):
     """Helper function to check config details and create nlp instantiation"""
+    new_nlp_service_object = create_nlp_service(config_dict)
+    config_name = config_dict["name"]
+    with config_update():
+        config_store.save_config(config_name, new_nlp_service_object.jsonString)
+        add_nlp_service(new_nlp_service_object)
+    return config_name
+
 
+def create_nlp_service(config_dict):
+    """Checks the config details and returns a new NLP service object for them"""
     if "nlpServiceType" not in config_dict:
         raise KeyError("'nlpService' must be a key in config")
     if "name" not in config_dict:
@@ -39,21 +81,127 @@ def persist_config_helper(config_dict):
     if "config" not in config_dict:
         raise KeyError("'config' must be a key in config")
     config_name = config_dict["name"]
+    if not config_name or config_name.startswith('.') or '/' in config_name:
+        raise ValueError("config name must not be empty, start with '.' or contain '/':" + str(config_name))
     nlp_service_type = config_dict["nlpServiceType"]
     if nlp_service_type.lower() not in all_nlp_services.keys():
-        raise ValueError("only 'acd' and 'quickumls' allowed at this time:" + nlp_service_type)
-    json_file = open(configDir + f'/{config_name}', 'w')
-    json_file.write(json.dumps(config_dict))
-
-    new_nlp_service_object = all_nlp_services[nlp_service_type.lower()](json.dumps(config_dict))
-    nlp_services_dict[config_dict["name"]] = new_nlp_service_object
-    return config_name
+        raise ValueError("only 'acd', 'quickumls' and 'dictionary' allowed at this time:" + nlp_service_type)
+    if not isinstance(config_dict.get("cacheEnabled", True), bool):
+        raise ValueError("'cacheEnabled' must be true or false")
+    fallback_config = config_dict.get("fallbackConfig")
+    if fallback_config is not None and (not isinstance(fallback_config, str) or fallback_config == config_name):
+        raise ValueError("'fallbackConfig' must be the name of another config")
+    return get_nlp_service_class(nlp_service_type.lower())(json.dumps(config_dict))
+
+
+def get_nlp_service_class(nlp_service_type):
+    """Returns the NLP service class of a config type, importing its module (and engine sdk) on first use"""
+    module_name, class_name = all_nlp_services[nlp_service_type].rsplit('.', 1)
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+def add_nlp_service(new_nlp_service_object):
+    """Publishes the NLP service, closing the service of the same config that it replaces"""
+    config_name = new_nlp_service_object.config_name
+    with nlp_config.lock:
+        current = nlp_config.current
+        replaced_nlp_service = current.services.get(config_name)
+        services = dict(current.services)
+        services[config_name] = new_nlp_service_object
+        nlp_config.publish(current.replace(services=services))
+    if replaced_nlp_service is not None:
+        replaced_nlp_service.close()
+
+
+@contextlib.contextmanager
+def config_update():
+    """
+    Holds the config lock of this process and the lock of the config store while a config change
+    is made, after loading the changes of other worker processes, so that no change is lost.
+    """
+    with nlp_config.lock, config_store.locked():
+        sync_configs()
+        yield
+
+
+def publish_settings(config):
+    """Publishes the config snapshot and saves its default and overrides in the store (in config_update)"""
+    nlp_config.publish(config)
+    config_store.save_settings(config.default_name, config.overrides)
+
+
+def sync_configs():
+    """
+    Makes the current config snapshot match the config store: configs that were added or changed
+    are created (in parallel), deleted configs are closed, and the default and overrides are loaded.
+    Returns the names of the configs that were created.
+    """
+    configs = config_store.read_configs()
+    default_name, overrides = config_store.read_settings()
+
+    def create(config_name):
+        try:
+            return create_nlp_service(json.loads(configs[config_name]))
+        except Exception:
+            logger.exception("Error when trying to load config %s...skipping", config_name)
+            return None
+
+    with nlp_config.lock:
+        current = nlp_config.current
+        changed = [config_name for config_name, json_string in configs.items()
+                   if config_name not in current.services or current.services[config_name].jsonString != json_string]
+        with ThreadPoolExecutor(max_workers=max(len(changed), 1), thread_name_prefix="load-config") as pool:
+            created = {config_name: nlp_service for config_name, nlp_service in zip(changed, pool.map(create, changed))
+                       if nlp_service is not None}
+        services = {}
+        for config_name in list(current.services) + list(configs):  # keeps the order the configs were added in
+            if config_name not in configs or config_name in services:
+                continue
+            nlp_service = created.get(config_name) or current.services.get(config_name)
+            if nlp_service is not None:
+                services[config_name] = nlp_service
+        if default_name not in services:
+            default_name = None
+        overrides = {resource_name: config_name for resource_name, config_name in overrides.items()
+                     if config_name in services}
+        nlp_config.publish(current.replace(services=services, default_name=default_name, overrides=overrides))
+    for config_name, nlp_service in current.services.items():
+        if services.get(config_name) is not nlp_service:
+            nlp_service.close()  # deleted or replaced
+    return list(created)
+
+
+def restore_configs():
+    """
+    Recreates the configs saved in the config store, and the default config and resource
+    overrides saved with them, so configs made through the API survive a restart.
+    """
+    with nlp_config.lock, config_store.locked(shared=True):
+        restored = sync_configs()
+    current = nlp_config.current
+    logger.info("Restored configs %s, default %s, overrides %s", restored, current.default_name, dict(current.overrides))
+
+
+def watch_config_store():
+    """Loads the config changes that other worker processes made, checking every config_sync_seconds"""
+    seen_version = config_store.version()
+    while True:
+        time.sleep(config_sync_seconds)
+        version = config_store.version()
+        if version == seen_version:
+            continue
+        try:
+            with nlp_config.lock, config_store.locked(shared=True):
+                version = config_store.version()
+                created = sync_configs()
+            seen_version = version
+            logger.info("Loaded config changes, created configs %s", created)
+        except Exception:
+            logger.exception("Error when trying to load config changes")
 
 
 def init_configs():
     """Create initial configs from deployment values, if any"""
-    global nlp_service
-
     logger.info("ACD enable config: %s", os.getenv("ACD_ENABLE_CONFIG"))
     logger.info("QuickUMLS enable config: %s", os.getenv("QUICKUMLS_ENABLE_CONFIG"))
 
@@ -69,7 +217,7 @@ def init_configs():
             details["flow"] = os.getenv("ACD_FLOW")
             tmp_config["config"] = details
             persist_config_helper(tmp_config)
-            logger.info("%s added:%s", tmp_config["name"], str(nlp_services_dict))
+            logger.info("%s added:%s", tmp_config["name"], str(list(nlp_config.current.services)))
         except Exception as ex:
             logger.exception("Error when trying to persist initial config...skipping:%s", str(ex))
 
@@ -83,29 +231,69 @@ def init_configs():
             details["endpoint"] = os.getenv("QUICKUMLS_ENDPOINT")
             tmp_config["config"] = details
             persist_config_helper(tmp_config)
-            logger.info("%s added:%s", tmp_config["name"], str(nlp_services_dict))
+            logger.info("%s added:%s", tmp_config["name"], str(list(nlp_config.current.services)))
         except Exception as ex:
             logger.exception("Error when trying to persist initial config...skipping:%s", str(ex))
 
     default_nlp_service = os.getenv("NLP_SERVICE_DEFAULT")
-    if default_nlp_service is not None and len(default_nlp_service) > 0:
-        if default_nlp_service in nlp_services_dict:
+    if nlp_config.current.default_name is not None:
+        logger.info("Keeping restored default nlp service %s", nlp_config.current.default_name)
+    elif default_nlp_service is not None and len(default_nlp_service) > 0:
+        if default_nlp_service in nlp_config.current.services:
             logger.info("Setting nlp service to %s", default_nlp_service)
-            nlp_service = nlp_services_dict[default_nlp_service]
+            with config_update():
+                publish_settings(nlp_config.current.replace(default_name=default_nlp_service))
         else:
             logger.info("%s is not a valid nlp instance", default_nlp_service)
 
 
+def warm_up_services():
+    """
+    Opens the backend connections and fetches the tokens of all configs in parallel, then
+    reports ready, so the first requests do not pay for the setup.
+    """
+    nlp_services = list(nlp_config.current.services.values())
+
+    def warm_up(nlp_service):
+        try:
+            nlp_service.warm_up()
+        except Exception:
+            logger.exception("Error when warming up config %s", nlp_service.config_name)
+
+    with ThreadPoolExecutor(max_workers=max(len(nlp_services), 1), thread_name_prefix="warm-up") as pool:
+        list(pool.map(warm_up, nlp_services))
+    logger.info("Warmed up configs %s, ready", [nlp_service.config_name for nlp_service in nlp_services])
+    ready.set()
+
+
+def run_kafka_worker():
+    """Enhances the bundles of the Kafka input topic with the default config, once ready (see nlp_kafka)"""
+    consumer, producer = nlp_kafka.create_clients()
+    worker = nlp_kafka.KafkaWorker(
+        consumer, producer, nlp_kafka.output_topic,
+        lambda records: enhance_records(nlp_config.current, records, request_concurrency),
+        lambda: ready.is_set() and nlp_config.current.default_service is not None)
+    logger.info("Enhancing Kafka topic %s into %s", nlp_kafka.input_topic, nlp_kafka.output_topic)
+    worker.run(threading.Event())
+
+
 configDir = setup_config_dir()
+config_store = ConfigStore(configDir)
+restore_configs()
 init_configs()
+job_runner = nlp_jobs.JobRunner(nlp_jobs.JobStore(os.path.join('text_analytics', 'jobs')))
+threading.Thread(target=warm_up_services, name="warm-up", daemon=True).start()
+threading.Thread(target=watch_config_store, name="config-watch", daemon=True).start()
+if nlp_kafka.kafka_enabled:
+    # one consumer per worker process; the consumer group balances the partitions over all of them
+    threading.Thread(target=run_kafka_worker, name="kafka-worker", daemon=True).start()
 
 
 @app.route("/config/<config_name>", methods=['GET'])
 def get_config(config_name):
     """Gets and returns the given config details"""
     try:
-        json_file = open(configDir + f'/{config_name}', 'r')
-        json_string = json_file.read()
+        json_string = config_store.read_config(config_name)
         c_dict = json.loads(json_string)
         if c_dict["nlpServiceType"] == "acd":
             c_dict["config"]["apikey"] = "*"*len(c_dict["config"]["apikey"])
@@ -117,6 +305,23 @@ def get_config(config_name):
     return Response(json_string, status=200, mimetype='application/json')
 
 
+@app.route("/config/<config_name>/stats", methods=['GET'])
+def get_config_stats(config_name):
+    """Gets and returns the connection statistics of the given config"""
+    nlp_service = nlp_config.current.services.get(config_name)
+    if nlp_service is None:
+        return Response("Config with the name: " + config_name + " doesn't exist.", status=400)
+    return Response(json.dumps(nlp_service.stats()), status=200, mimetype='application/json')
+
+
+@app.route("/backends", methods=['GET'])
+def get_backends():
+    """Gets and returns the concurrency limit and circuit breaker state of every config"""
+    services = nlp_config.current.services
+    return Response(json.dumps({config_name: nlp_service.guard_stats() for config_name, nlp_service in services.items()}),
+                    status=200, mimetype='application/json')
+
+
 @app.route("/config/definition", methods=['POST', 'PUT'])
 def persist_config():
     """Create a new named config"""
@@ -124,7 +329,7 @@ def persist_config():
         request_str = request.data.decode('utf-8')
         config_dict = json.loads(request_str)
         config_name = persist_config_helper(config_dict)
-        logger.info("%s added:%s", config_name, str(nlp_services_dict))
+        logger.info("%s added:%s", config_name, str(list(nlp_config.current.services)))
     except Exception as ex:
         logger.exception("Error when trying to persist given config.")
         return Response("Error when trying to persist given config-" + str(ex), status=400)
@@ -136,16 +341,19 @@ def persist_config():
 def delete_config(config_name):
     """Delete a config by name"""
     try:
-        if config_name not in nlp_services_dict:
-            raise KeyError(config_name + " must exist")
-        if nlp_service is not None:
-            current_config = json.loads(nlp_service.jsonString)
-            if config_name == current_config["name"]:
+        with config_update():
+            current = nlp_config.current
+            if config_name not in current.services:
+                raise KeyError(config_name + " must exist")
+            if config_name == current.default_name:
                 raise Exception("Cannot delete the default nlp service")
-        if config_name in list(override_resource_config.values()):
-            raise ValueError(config_name + " has an existing override and cannot be deleted")
-        os.remove(configDir + f'/{config_name}')
-        del nlp_services_dict[config_name]
+            if config_name in list(current.overrides.values()):
+                raise ValueError(config_name + " has an existing override and cannot be deleted")
+            config_store.delete_config(config_name)
+            services = dict(current.services)
+            deleted_nlp_service = services.pop(config_name)
+            nlp_config.publish(current.replace(services=services))
+        deleted_nlp_service.close()
     except Exception as ex:
         logger.exception("Error when trying to delete config")
         return Response("Error when trying to delete config-" + str(ex), status=400)
@@ -156,7 +364,7 @@ def delete_config(config_name):
 @app.route("/all_configs", methods=['GET'])
 def get_all_configs():
     """Get and return all configs by name"""
-    configs = list(nlp_services_dict.keys())
+    configs = list(nlp_config.current.services.keys())
     if not configs:
         output = 'No configs found'
     else:
@@ -167,6 +375,7 @@ def get_all_configs():
 
 @app.route("/config", methods=['GET'])
 def get_current_config():
+    nlp_service = nlp_config.current.default_service
     if nlp_service is None:
         return Response("No default nlp service is currently set", status=400)
     return Response(nlp_service.config_name, status=200, mimetype='application/plaintext')
@@ -175,13 +384,14 @@ def get_current_config():
 @app.route("/config/setDefault", methods=['POST', 'PUT'])
 def set_default_config():
     """Set the default nlp instance"""
-    global nlp_service
     if request.args and request.args.get('name'):
         config_name = request.args.get('name')
         try:
-            if config_name not in nlp_services_dict:
-                raise KeyError(config_name + " is not a config")
-            nlp_service = nlp_services_dict[config_name]
+            with config_update():
+                current = nlp_config.current
+                if config_name not in current.services:
+                    raise KeyError(config_name + " is not a config")
+                publish_settings(current.replace(default_name=config_name))
             return Response('Default config set to: ' + config_name, status=200, mimetype='application/plaintext')
         except Exception:
             logger.exception('Error in setting default with a config name of: %s', config_name)
@@ -194,38 +404,43 @@ def set_default_config():
 @app.route("/config/clearDefault", methods=['POST', 'PUT'])
 def clear_default_config():
     """Clear the default nlp instance"""
-    global nlp_service
-    nlp_service = None
+    with config_update():
+        publish_settings(nlp_config.current.replace(default_name=None))
     return Response('Default config has been cleared', status=200, mimetype='application/plaintext')
 
 
 @app.route("/config/resource", methods=['GET'])
 def get_current_override_configs():
     """Get and return all override definitions"""
-    return Response(str(override_resource_config), status=200, mimetype='application/plaintext')
+    return Response(str(dict(nlp_config.current.overrides)), status=200, mimetype='application/plaintext')
 
 
 @app.route("/config/resource/<resource_name>", methods=['GET'])
 def get_current_override_config(resource_name):
     """Get and return override for this resource"""
-    if resource_name not in override_resource_config:
+    overrides = nlp_config.current.overrides
+    if resource_name not in overrides:
         return Response('No override for this resource: ' + resource_name, status=400)
-    return Response(override_resource_config[resource_name], status=200, mimetype='application/plaintext')
+    return Response(overrides[resource_name], status=200, mimetype='application/plaintext')
 
 
 @app.route("/config/resource/<resource_name>/<config_name>", methods=['POST', 'PUT'])
 def setup_override_config(resource_name, config_name):
     """Create a new override for a given resource"""
     try:
-        if config_name not in nlp_services_dict:
-            raise KeyError(config_name + " is not a config")
-        temp_nlp_service = nlp_services_dict[config_name]
-        if resource_name not in temp_nlp_service.types_can_handle:
-            raise ValueError(resource_name + " cannot be handled by " + config_name)
+        with config_update():
+            current = nlp_config.current
+            if config_name not in current.services:
+                raise KeyError(config_name + " is not a config")
+            temp_nlp_service = current.services[config_name]
+            if resource_name not in temp_nlp_service.types_can_handle:
+                raise ValueError(resource_name + " cannot be handled by " + config_name)
 
-        override_resource_config[resource_name] = config_name
+            overrides = dict(current.overrides)
+            overrides[resource_name] = config_name
+            publish_settings(current.replace(overrides=overrides))
 
-        return Response(str(override_resource_config), status=200, mimetype='application/plaintext')
+        return Response(str(overrides), status=200, mimetype='application/plaintext')
     except Exception:
         logger.exception('Error in setting up override for resource: %s', resource_name)
         return Response('Error in setting up override for resource: ' + resource_name, status=400)
@@ -235,7 +450,11 @@ def setup_override_config(resource_name, config_name):
 def delete_resource(resource_name):
     """Delete a resource override by name"""
     try:
-        del override_resource_config[resource_name]
+        with config_update():
+            current = nlp_config.current
+            overrides = dict(current.overrides)
+            del overrides[resource_name]
+            publish_settings(current.replace(overrides=overrides))
     except Exception:
         return Response("Error when trying to delete override for resource: " + resource_name, status=400)
     logger.info("Override successfully deleted: %s", resource_name)
@@ -246,69 +465,440 @@ def delete_resource(resource_name):
 def delete_resources():
     """Delete all resource overrides"""
     try:
-        override_resource_config.clear()
+        with config_update():
+            publish_settings(nlp_config.current.replace(overrides={}))
     except Exception:
         return Response("Error when trying to delete all overrides", status=400)
     logger.info("Overrides successfully deleted")
     return Response("Overrides successfully deleted", status=200)
 
 
+@app.route("/cache", methods=['GET'])
+def get_cache_stats():
+    """Get and return the NLP response cache statistics"""
+    return Response(json.dumps(response_cache.stats()), status=200, mimetype='application/json')
+
+
+@app.route("/cache", methods=['DELETE'])
+def clear_cache():
+    """Remove all entries from the NLP response cache"""
+    response_cache.clear()
+    logger.info("NLP response cache cleared")
+    return Response("NLP response cache cleared", status=200)
+
+
+@app.route("/metrics", methods=['GET'])
+def get_metrics():
+    """Return the stage latency histograms and counters in the Prometheus text format"""
+    return Response(nlp_metrics.registry.render(), status=200, mimetype='text/plain; version=0.0.4')
+
+
+@app.route("/ready", methods=['GET'])
+def get_ready():
+    """Readiness: 200 once the configs restored at startup have their backend connections set up"""
+    if not ready.is_set():
+        return Response("Starting", status=503)
+    return Response("Ready", status=200)
+
+
 @app.route("/discoverInsights", methods=['POST'])
 def discover_insights():
     """Process a bundle or a resource to enhance/augment with insights"""
-    if nlp_service is None:
+    config = nlp_config.current  # route the whole request with the same config snapshot
+    if config.default_service is None:
         return Response("No NLP service configured-need to set a default config", status=400)
 
-    fhir_data = json.loads(request.data)  # could be resource or bundle
-
-    input_type = fhir_data['resourceType']
-    resp_string = None
-    new_entries = []
-    if input_type == 'Bundle':
-        entrylist = fhir_data['entry']
-        for entry in entrylist:
-            if entry["resource"]["resourceType"] in nlp_service.types_can_handle:
-                resp = process_resource(entry["resource"])
-                if resp['resourceType'] == 'Bundle':
-                    # response is a bundle of new resources to keep for later
-                    for new_entry in resp['entry']:
-                        new_entries.append(new_entry)  # keep new resources to be added later
-                else:
-                    entry["resource"] = resp  # update existing resource
-
-        for new_entry in new_entries:
-            entrylist.append(new_entry)  # add new resources to bundle
-
-        resp_string = fhir_data
-    else:
-        resp_string = process_resource(fhir_data)  # single resource so just return response
+    try:
+        concurrency = get_request_concurrency(request.args.get('concurrency'))
+    except ValueError:
+        return Response("Query parameter 'concurrency' must be a positive integer", status=400)
+
+    try:
+        deadline_seconds = get_request_deadline(request.args.get('deadline', request.headers.get('X-NLP-Deadline')))
+    except ValueError:
+        return Response("Query parameter 'deadline' and header 'X-NLP-Deadline' must be a positive number of seconds",
+                        status=400)
+
+    body, error_response = read_request_body()
+    if error_response is not None:
+        return error_response
+
+    fhir_data, error_response = parse_request_record(body)  # could be resource or bundle
+    if error_response is not None:
+        return error_response
+
+    unfinished = []
+    with nlp_deadline.deadline_after(deadline_seconds):
+        resp_string = enhance_records(config, [fhir_data], concurrency, unfinished)[0]
+
+    with nlp_metrics.response_serialize_seconds.time():
+        return_response = fast_json.dumps_bytes(resp_string)  # back to json
+
+    headers = {}
+    if unfinished:
+        # positions of the bundle entries (0 for a single resource) returned as is
+        headers['X-NLP-Unfinished'] = ",".join(str(position) for record_index, position in unfinished)
+    return compressed_response(return_response, 'application/json', headers)
+
+
+@app.route("/discoverInsights/jobs", methods=['POST'])
+def submit_insights_job():
+    """Queue a bundle or a resource to be enhanced in the background, and return the status of its job"""
+    config = nlp_config.current  # the job is routed with the config snapshot of its submission
+    if config.default_service is None:
+        return Response("No NLP service configured-need to set a default config", status=400)
 
-    return_response = json.dumps(resp_string)  # back to string
+    try:
+        concurrency = get_request_concurrency(request.args.get('concurrency'))
+    except ValueError:
+        return Response("Query parameter 'concurrency' must be a positive integer", status=400)
+
+    body, error_response = read_request_body()
+    if error_response is not None:
+        return error_response
 
-    return Response(return_response, status=200, mimetype='application/json')
+    fhir_data, error_response = parse_request_record(body)  # could be resource or bundle
+    if error_response is not None:
+        return error_response
 
+    try:
+        status = job_runner.submit(lambda: enhance_records(config, [fhir_data], concurrency)[0])
+    except nlp_jobs.QueueFull:
+        return Response("Too many jobs waiting, retry later", status=429, headers={'Retry-After': '30'})
+    logger.info("Job %s queued", status["id"])
+    response = job_status_response(status, 202)
+    response.headers['Location'] = "/discoverInsights/jobs/" + status["id"]
+    return response
+
+
+@app.route("/discoverInsights/jobs/<job_id>", methods=['GET'])
+def get_insights_job(job_id):
+    """Get and return the status of a job: 202 while it is queued or working, 200 once it is done"""
+    status = job_runner.store.read_status(job_id)
+    if status is None:
+        return Response("No such job (jobs expire after " + str(int(nlp_jobs.job_ttl_seconds)) + " seconds): " + job_id,
+                        status=404)
+    if status["status"] == nlp_jobs.ERROR:
+        return job_status_response(status, 500)
+    return job_status_response(status, 200 if status["status"] == nlp_jobs.DONE else 202)
+
+
+@app.route("/discoverInsights/jobs/<job_id>/result", methods=['GET'])
+def get_insights_job_result(job_id):
+    """Get and return the enhanced bundle or resource of a job that is done"""
+    status = job_runner.store.read_status(job_id)
+    if status is None or status["status"] != nlp_jobs.DONE:
+        return get_insights_job(job_id)
+    try:
+        body = job_runner.store.read_result(job_id)
+    except FileNotFoundError:  # expired since its status was read
+        return get_insights_job(job_id)
+    return compressed_response(body, 'application/json')
+
+
+def job_status_response(status, code):
+    status_url = "/discoverInsights/jobs/" + status["id"]
+    status = dict(status, statusUrl=status_url)
+    if status["status"] == nlp_jobs.DONE:
+        status["resultUrl"] = status_url + "/result"
+    return Response(json.dumps(status), status=code, mimetype='application/json')
+
+
+@app.route("/discoverInsights/ndjson", methods=['POST'])
+def discover_insights_ndjson():
+    """
+    Process newline delimited json resources and/or bundles, streaming back each
+    enhanced record as a line, in the same order, as soon as its batch is done
+    """
+    config = nlp_config.current  # route the whole request with the same config snapshot
+    if config.default_service is None:
+        return Response("No NLP service configured-need to set a default config", status=400)
+
+    try:
+        concurrency = get_request_concurrency(request.args.get('concurrency'))
+    except ValueError:
+        return Response("Query parameter 'concurrency' must be a positive integer", status=400)
+
+    try:
+        lines = iter(compression.decompressed_lines(request.stream, request.headers.get('Content-Encoding')))
+        first_line = next(lines, None)  # a body that is corrupt from the start is rejected before streaming
+    except DECOMPRESSION_ERRORS as ex:
+        return decompression_error_response(ex)
+
+    decode_errors = []
+
+    def read_lines():
+        """The lines of the body; decoding errors later in the body end it after the lines read so far"""
+        if first_line is None:
+            return
+        yield first_line
+        try:
+            yield from lines
+        except (compression.TooLarge, zlib.error) as ex:
+            logger.warning("Error when decompressing ndjson body: %s", ex)
+            decode_errors.append(ex)
+
+    def generate():
+        for batch in read_ndjson_batches(read_lines(), ndjson_batch_size):
+            for record in enhance_ndjson_batch(config, batch, concurrency):
+                with nlp_metrics.response_serialize_seconds.time():
+                    line = fast_json.dumps_bytes(record) + b'\n'
+                yield line
+        for ex in decode_errors:
+            yield fast_json.dumps_bytes(create_operation_outcome("Request body could not be decompressed-" + str(ex))) + b'\n'
+
+    encoding = compression.choose_encoding(request.headers.get('Accept-Encoding'))
+    if encoding is None:
+        return Response(stream_with_context(generate()), status=200, mimetype='application/x-ndjson',
+                        headers={'Vary': 'Accept-Encoding'})
+    return Response(stream_with_context(compression.compress_stream(generate(), encoding)), status=200,
+                    mimetype='application/x-ndjson', headers={'Content-Encoding': encoding, 'Vary': 'Accept-Encoding'})
+
+
+def compressed_response(body, mimetype, headers=None):
+    """Returns a response with the body, compressed when the client accepts gzip or deflate and the body is large enough"""
+    headers = dict(headers or {}, Vary='Accept-Encoding')
+    encoding = compression.choose_encoding(request.headers.get('Accept-Encoding'))
+    if encoding is not None and len(body) >= compression.compression_min_bytes:
+        body = compression.compress(body, encoding)
+        headers['Content-Encoding'] = encoding
+    return Response(body, status=200, mimetype=mimetype, headers=headers)
+
+
+def read_ndjson_batches(stream, batch_size):
+    """Yields lists of at most batch_size non-empty lines read from the stream"""
+    batch = []
+    for line in stream:
+        if line.strip():
+            batch.append(line)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+
+def enhance_ndjson_batch(config, lines, concurrency):
+    """
+    Enhances a batch of ndjson lines together and returns the enhanced records.
+    If the batch fails, its records are enhanced one at a time so that only the records
+    that fail are answered with an OperationOutcome.
+    """
+    try:
+        return enhance_records(config, [parse_record(line) for line in lines], concurrency)
+    except Exception:
+        logger.exception("Error when enhancing ndjson batch, retrying its records one at a time")
+    records = []
+    for line in lines:
+        try:
+            records.append(enhance_records(config, [parse_record(line)], concurrency)[0])
+        except Exception as ex:
+            logger.exception("Error when enhancing ndjson record")
+            records.append(create_operation_outcome("Error when enhancing record-" + str(ex)))
+    return records
 
-def process_resource(request_data):
-    """Generate insights for a single resource"""
-    global nlp_service
+
+def parse_record(data):
+    """Parses a request body or ndjson line, recording its size and parse time"""
+    nlp_metrics.request_size_bytes.observe(len(data))
+    with nlp_metrics.json_parse_seconds.time():
+        return fast_json.loads(data)
+
+
+def read_request_body():
+    """Returns the decompressed request body and None, or None and the error response"""
+    try:
+        return compression.decompress(request.get_data(), request.headers.get('Content-Encoding')), None
+    except DECOMPRESSION_ERRORS as ex:
+        return None, decompression_error_response(ex)
+
+
+def decompression_error_response(ex):
+    """Returns the error response for one of DECOMPRESSION_ERRORS"""
+    if isinstance(ex, compression.UnsupportedEncoding):
+        return Response("Content-Encoding must be gzip, deflate or identity", status=415)
+    if isinstance(ex, compression.TooLarge):
+        return Response(str(ex), status=413)
+    return Response("Request body could not be decompressed", status=400)
+
+
+def parse_request_record(body):
+    """Returns the record (bundle or resource) of a request body and None, or None and the error response"""
+    try:
+        return parse_record(body), None
+    except ValueError:
+        return None, Response("Request body must be a json bundle or resource", status=400)
+
+
+def create_operation_outcome(message):
+    return {"resourceType": "OperationOutcome",
+            "issue": [{"severity": "error", "code": "processing", "diagnostics": message}]}
+
+
+def enhance_records(config, records, concurrency, unfinished=None):
+    """
+    Enhance a list of records (each a bundle or a resource) with insights and return them in the same order.
+    The eligible resources of all records are enhanced together, so each distinct text is analyzed once.
+    Resources that could not be enhanced before the deadline (see nlp_deadline) are left as they are,
+    and their record index and entry position (0 for a single resource) are added to unfinished.
+    """
+    types_can_handle = config.default_service.types_can_handle
+    entries_to_process = []  # record index, entry position and bundle entry (None for a single resource)
+    resources = []
+    for index, fhir_data in enumerate(records):
+        if fhir_data['resourceType'] == 'Bundle':
+            for position, entry in enumerate(fhir_data['entry']):
+                if entry["resource"]["resourceType"] in types_can_handle:
+                    entries_to_process.append((index, position, entry))
+                    resources.append(entry["resource"])
+        else:
+            entries_to_process.append((index, 0, None))
+            resources.append(fhir_data)
+
+    fingerprints = [None] * len(resources)
+    if incremental_mode:
+        fingerprints = [resource_fingerprint(config, resource) for resource in resources]
+    to_analyze = [resource for resource, fingerprint in zip(resources, fingerprints)
+                  if fingerprint is None or fingerprint != get_fingerprint(resource)]
+
+    # analyze each distinct text once, then build insights from those responses
+    nlp_responses = analyze_texts(config, plan_texts(config, to_analyze), concurrency)
+    planned_services = {config_name: PlannedNLPService(config.services[config_name], config_responses, config)
+                        for config_name, config_responses in nlp_responses.items()}
+    responses = run_bounded(lambda job: process_resource_by_deadline(config, job[0], planned_services, job[1]),
+                            list(zip(resources, fingerprints)), concurrency)
+
+    enhanced_records = list(records)
+    new_entries = [[] for record in records]
+    for (index, position, entry), resp in zip(entries_to_process, responses):
+        if resp is None:
+            if unfinished is not None:
+                unfinished.append((index, position))  # resource is left as it is
+        elif entry is None:
+            enhanced_records[index] = resp  # single resource so just return response
+        elif resp['resourceType'] == 'Bundle':
+            # response is a bundle of new resources to keep for later
+            for new_entry in resp['entry']:
+                new_entries[index].append(new_entry)  # keep new resources to be added later
+        else:
+            entry["resource"] = resp  # update existing resource
+
+    for fhir_data, record_new_entries in zip(records, new_entries):
+        for new_entry in record_new_entries:
+            fhir_data['entry'].append(new_entry)  # add new resources to bundle
+
+    return enhanced_records
+
+
+def get_request_deadline(requested):
+    """Returns the seconds this request may take, or None for no deadline"""
+    if requested is None:
+        return nlp_deadline.default_deadline_seconds or None
+    seconds = float(requested)
+    if not seconds > 0:
+        raise ValueError(requested)
+    return seconds
+
+
+def get_request_concurrency(requested):
+    """Returns the number of bundle entries that may be enhanced at once for this request"""
+    concurrency = request_concurrency
+    if requested is not None:
+        concurrency = int(requested)
+        if concurrency < 1:
+            raise ValueError(requested)
+    return max(min(concurrency, max_concurrency), 1)
+
+
+def run_bounded(func, items, concurrency):
+    """
+    Calls func for each item on the shared worker pool, at most concurrency at a time.
+    Results are returned in the same order as the items.
+    """
+    if concurrency <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+
+    slots = threading.BoundedSemaphore(concurrency)
+    futures = []
+    for item in items:
+        slots.acquire()
+        future = bundle_executor.submit(contextvars.copy_context().run, func, item)  # keeps the request deadline
+        future.add_done_callback(lambda f: slots.release())
+        futures.append(future)
+    return [future.result() for future in futures]
+
+
+def analyze_texts(config, plan, concurrency):
+    """
+    Analyzes each text of the plan (config name -> texts) once with its config.
+    Returns a dict of config name -> dict of text -> NLP response.
+    """
+    jobs = [(config_name, text) for config_name, texts in plan.items() for text in texts]
+    logger.info("Analyzing %d distinct texts", len(jobs))
+    responses = run_bounded(lambda job: analyze_text_by_deadline(config, config.services[job[0]], job[1]), jobs, concurrency)
+    nlp_responses = {config_name: {} for config_name in plan}
+    for (config_name, text), response in zip(jobs, responses):
+        if response is not None:
+            nlp_responses[config_name][text] = response
+    return nlp_responses
+
+
+def analyze_text_by_deadline(config, nlp_service, text):
+    """Returns the NLP response for the text, or None when the request deadline passed first"""
+    try:
+        return nlp_service.process(text, config=config)
+    except nlp_deadline.DeadlineExceeded:
+        return None
+
+
+def process_resource_by_deadline(config, request_data, planned_services, fingerprint):
+    """Returns process_resource(), or None when the request deadline passed before the resource was enhanced"""
+    try:
+        return process_resource(config, request_data, planned_services, fingerprint)
+    except nlp_deadline.DeadlineExceeded:
+        nlp_metrics.resources_unfinished.inc(resource_type=request_data['resourceType'])
+        logger.info("Request deadline exceeded so respond back with original resource")
+        return None
+
+
+def process_resource(config, request_data, planned_services=None, fingerprint=None):
+    """
+    Generate insights for a single resource, using the NLP services of the given config snapshot.
+    planned_services optionally holds the PlannedNLPService of each config (config name -> service) with
+    the responses the request analyzed ahead of time.
+    With a fingerprint (see resource_fingerprint), a resource that already has it is returned as is,
+    and an enhanced resource gets it saved in its insight meta.
+    """
     resource_type = request_data['resourceType']
     logger.info("Processing resource type: %s", resource_type)
-    nlp_service_backup = nlp_service  # save original to reset later
-    if resource_type in override_resource_config:
-        nlp_service = nlp_services_dict[override_resource_config[resource_type]]
-        logger.info("NLP engine override for %s using %s", resource_type, override_resource_config[resource_type])
-
-    if resource_type in nlp_service.types_can_handle:
-        enhance_func = nlp_service.types_can_handle[resource_type]
-        resp = enhance_func(nlp_service, request_data)
-        json_response = json.loads(resp)
+    if fingerprint is not None and fingerprint == get_fingerprint(request_data):
+        nlp_metrics.resources_unchanged.inc(resource_type=resource_type)
+        logger.info("Resource already enhanced from the same texts and config so respond back with original")
+        return request_data
+    nlp = config.service_for(resource_type)
+    if resource_type in config.overrides:
+        logger.info("NLP engine override for %s using %s", resource_type, config.overrides[resource_type])
+    if planned_services and nlp.config_name in planned_services:
+        nlp = planned_services[nlp.config_name]
+    else:
+        nlp = PlannedNLPService(nlp, {}, config)  # nothing analyzed ahead, but the evidence is still encoded once
+
+    if resource_type in nlp.types_can_handle:
+        with nlp_metrics.enhance_seconds.time(resource_type=resource_type):
+            if strict_validation or resource_type not in enhance_to_dict:
+                enhance_func = nlp.types_can_handle[resource_type]
+                resp = enhance_func(nlp, request_data)
+                json_response = fast_json.loads(resp)
+            else:
+                json_response = enhance_to_dict[resource_type](nlp, request_data)
+        if fingerprint is not None and json_response.get('resourceType') == resource_type:
+            set_fingerprint(json_response, fingerprint)
+        nlp_metrics.resources_processed.inc(resource_type=resource_type)
 
         logger.info("Resource successfully updated")
-        nlp_service = nlp_service_backup
         return json_response
     else:
         logger.info("Resource not handled so respond back with original")
-        nlp_service = nlp_service_backup
         return request_data
 
 
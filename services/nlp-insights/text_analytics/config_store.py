@@ -0,0 +1,94 @@
+import contextlib
+import fcntl
+import json
+import os
+import threading
+
+# Files of the store that are not configs
+SETTINGS_FILE = '.settings'  # the default config and the resource overrides
+VERSION_FILE = '.version'    # replaced on every change, so other processes notice it with a single stat
+LOCK_FILE = '.lock'
+
+
+class ConfigStore:
+    """
+    Configs, default config and resource overrides saved in a directory, shared by the worker processes.
+
+    Each config is a json file named after the config, and the default and overrides are in one
+    settings file.  Changes are made while holding an exclusive lock on the directory and end by
+    replacing the version file, which the other processes watch (see version()) to reload the store.
+    All files are written to a temporary file first and then renamed, so readers never see a
+    partly written file.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    @contextlib.contextmanager
+    def locked(self, shared=False):
+        """Holds the lock of the store: shared to read a consistent store, else to change it"""
+        with open(self._path(LOCK_FILE), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def version(self):
+        """Returns a value that changes whenever the store changes"""
+        try:
+            stat = os.stat(self._path(VERSION_FILE))
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns
+
+    def read_configs(self):
+        """Returns the json string of every config, by config name"""
+        configs = {}
+        for config_name in sorted(os.listdir(self.directory)):
+            if config_name.startswith('.'):
+                continue
+            try:
+                with open(self._path(config_name), 'r') as json_file:
+                    configs[config_name] = json_file.read()
+            except FileNotFoundError:  # deleted by another process that does not hold the lock yet
+                pass
+        return configs
+
+    def read_config(self, config_name):
+        with open(self._path(config_name), 'r') as json_file:
+            return json_file.read()
+
+    def read_settings(self):
+        """Returns the default config name and the resource overrides"""
+        try:
+            with open(self._path(SETTINGS_FILE), 'r') as json_file:
+                settings = json.loads(json_file.read())
+        except FileNotFoundError:
+            settings = {}
+        return settings.get("default"), settings.get("overrides") or {}
+
+    def save_config(self, config_name, json_string):
+        self._write(config_name, json_string)
+        self._changed()
+
+    def delete_config(self, config_name):
+        os.remove(self._path(config_name))
+        self._changed()
+
+    def save_settings(self, default_name, overrides):
+        self._write(SETTINGS_FILE, json.dumps({"default": default_name, "overrides": dict(overrides)}))
+        self._changed()
+
+    def _changed(self):
+        self._write(VERSION_FILE, "%d %d" % (os.getpid(), threading.get_ident()))
+
+    def _write(self, file_name, content):
+        temp_file = self._path(".%s.%d.%d.tmp" % (file_name, os.getpid(), threading.get_ident()))
+        with open(temp_file, 'w') as json_file:
+            json_file.write(content)
+        os.replace(temp_file, self._path(file_name))
+
+    def _path(self, file_name):
+        return os.path.join(self.directory, file_name)
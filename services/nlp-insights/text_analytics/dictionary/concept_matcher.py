@@ -0,0 +1,106 @@
+import collections
+import re
+
+# Tokens are runs of letters and digits; everything else separates them
+TOKEN_PATTERN = re.compile(r"[^\W_]+")
+
+
+def normalize_token(token):
+    return token.casefold()
+
+
+def tokenize(text):
+    """Returns (normalized token, begin, end) for each token of the text"""
+    return [(normalize_token(m.group(0)), m.start(), m.end()) for m in TOKEN_PATTERN.finditer(text)]
+
+
+class ConceptMatcher:
+    """
+    Finds the terms of a concept dictionary in texts.
+
+    The terms are compiled into an Aho-Corasick automaton over normalized tokens (case folded,
+    punctuation and spacing ignored), so a text is matched against all terms in a single pass.
+    Of overlapping matches the longest one is kept, and a term shared by several concepts
+    matches all of them.
+    """
+
+    def __init__(self, concepts):
+        """concepts is a list of dicts with a cui, a term (preferred name), terms and semtypes"""
+        self.concepts = []
+        self._goto = [{}]   # state -> {token: next state}
+        self._fail = [0]    # state -> state of the longest proper suffix that is also a prefix
+        self._output = [[]]  # state -> [(number of tokens, concept index)] of the terms ending here
+        self.term_count = 0
+        for concept in concepts:
+            terms = concept.get("terms") or [concept["term"]]
+            self.concepts.append({"cui": concept["cui"],
+                                  "term": concept.get("term") or terms[0],
+                                  "semtypes": list(concept.get("semtypes") or [])})
+            for term in set(terms):
+                self._add_term(term, len(self.concepts) - 1)
+        self._build_failure_links()
+
+    def _add_term(self, term, concept_index):
+        tokens = [token for token, begin, end in tokenize(term)]
+        if not tokens:
+            return
+        state = 0
+        for token in tokens:
+            next_state = self._goto[state].get(token)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto[state][token] = next_state
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append([])
+            state = next_state
+        if (len(tokens), concept_index) not in self._output[state]:  # terms that only differ in case or punctuation
+            self._output[state].append((len(tokens), concept_index))
+            self.term_count += 1
+
+    def _build_failure_links(self):
+        queue = collections.deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for token, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fallback = self._fail[state]
+                while fallback and token not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                self._fail[next_state] = self._goto[fallback].get(token, 0)
+                # terms ending at the suffix state also end here
+                self._output[next_state] = self._output[next_state] + self._output[self._fail[next_state]]
+
+    def match(self, text):
+        """
+        Returns the concepts found in the text, as dicts in the format of the QuickUMLS
+        service (cui, term, ngram, start, end, semtypes, similarity), ordered by position.
+        """
+        tokens = tokenize(text)
+        candidates = []  # (first token, last token, concept index)
+        state = 0
+        for position, (token, begin, end) in enumerate(tokens):
+            while state and token not in self._goto[state]:
+                state = self._fail[state]
+            state = self._goto[state].get(token, 0)
+            for length, concept_index in self._output[state]:
+                candidates.append((position - length + 1, position, concept_index))
+
+        # keep the longest matches, leftmost first, that do not overlap a longer one
+        candidates.sort(key=lambda candidate: (candidate[0] - candidate[1], candidate[0]))
+        taken = [None] * len(tokens)  # token -> (first, last) of the match covering it
+        selected = []
+        for first, last, concept_index in candidates:
+            span = (first, last)
+            if all(taken[i] is None or taken[i] == span for i in range(first, last + 1)):
+                for i in range(first, last + 1):
+                    taken[i] = span
+                selected.append((first, last, concept_index))
+
+        matches = []
+        for first, last, concept_index in sorted(selected):
+            concept = self.concepts[concept_index]
+            begin, end = tokens[first][1], tokens[last][2]
+            matches.append({"cui": concept["cui"], "term": concept["term"], "ngram": text[begin:end],
+                            "start": begin, "end": end, "semtypes": concept["semtypes"], "similarity": 1.0})
+        return matches
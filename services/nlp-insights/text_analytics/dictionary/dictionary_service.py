@@ -0,0 +1,75 @@
+import json
+import logging
+import os
+
+from text_analytics.abstract_nlp_service import NLPService
+from text_analytics.dictionary.concept_matcher import ConceptMatcher
+from text_analytics.enhance import *
+from text_analytics.quickUMLS.quickUMLS_service import QuickUMLSService
+
+logger = logging.getLogger()
+
+# Directory of the dictionary files; the dictionaryFile of a config must be inside it
+dictionary_dir = os.getenv("NLP_DICTIONARY_DIR", "dictionaries")
+
+
+class DictionaryService(NLPService):
+    """
+    NLP service that matches the terms of a local concept dictionary, in process.
+
+    The dictionary is a json list of concepts, each with a "cui", a preferred name "term", the
+    "terms" (synonyms) to match and the UMLS "semtypes", loaded from the "dictionaryFile" of the
+    config or given inline as "concepts".  Concepts are returned in the same format as QuickUMLS,
+    with "dictionary" as their generatingService.
+    """
+    types_can_handle = {'AllergyIntolerance': enhance_allergy_intolerance_payload_to_fhir,
+                        'Immunization': enhance_immunization_payload_to_fhir,
+                        'DiagnosticReport': enhance_diagnostic_report_payload_to_fhir,
+                        'DocumentReference': enhance_document_reference_payload_to_fhir
+                        }
+
+    PROCESS_TYPE_UNSTRUCTURED = "Dictionary Unstructured"
+    PROCESS_TYPE_STRUCTURED = "Dictionary Structured"
+
+    def __init__(self, json_string):
+        super().__init__(json_string)
+        config_dict = json.loads(json_string)
+        # matching is cheaper than a cache lookup, so only cache when asked to
+        self.cache_enabled = config_dict.get("cacheEnabled", False)
+        details = config_dict["config"]
+        if details.get("concepts") is not None:
+            concepts = details["concepts"]
+        elif details.get("dictionaryFile") is not None:
+            with open(dictionary_path(details["dictionaryFile"])) as dictionary_file:
+                concepts = json.load(dictionary_file)
+        else:
+            raise KeyError("'dictionaryFile' or 'concepts' must be a key in the dictionary config")
+        self.matcher = ConceptMatcher(concepts)
+        logger.info("Dictionary %s loaded with %d concepts and %d terms",
+                    self.config_name, len(self.matcher.concepts), self.matcher.term_count)
+
+    def stats(self):
+        return {"concepts": len(self.matcher.concepts), "terms": self.matcher.term_count}
+
+    def process_many(self, texts, config=None):
+        # matching does not wait on anything, so there is nothing to gain from threads
+        return [self.process(text, config=config) for text in texts]
+
+    def analyze(self, text):
+        if type(text) is bytes:
+            text = text.decode('utf-8')
+        concepts_list = []
+        for concept in self.matcher.match(text):
+            output = QuickUMLSService.concept_to_dict(concept)
+            output["generatingService"] = "dictionary"
+            concepts_list.append(output)
+        return {"concepts": concepts_list}
+
+
+def dictionary_path(dictionary_file):
+    """Returns the path of a dictionary file relative to the dictionary directory, refusing paths outside it"""
+    directory = os.path.realpath(dictionary_dir)
+    path = os.path.realpath(os.path.join(directory, dictionary_file))
+    if os.path.commonpath([directory, path]) != directory:
+        raise ValueError("'dictionaryFile' must be a file in the dictionary directory " + dictionary_dir)
+    return path
@@ -1,6 +1,56 @@
-from .enhance_allergy_intolerance_payload import enhance_allergy_intolerance_payload_to_fhir
-from .enhance_diagnostic_report_payload import enhance_diagnostic_report_payload_to_fhir
-from .enhance_document_reference_payload import enhance_document_reference_payload_to_fhir
-from .enhance_immunization_payload import enhance_immunization_payload_to_fhir
+import importlib
 
 
+def _lazy(module_name, function_name):
+    """
+    Returns a function that calls function_name of the enhance module, importing the module on the
+    first call, so the FHIR models of a resource type are only loaded once that type is enhanced.
+    """
+    function = None
+
+    def call(*args, **kwargs):
+        nonlocal function
+        if function is None:
+            function = getattr(importlib.import_module('.' + module_name, __name__), function_name)
+        return function(*args, **kwargs)
+
+    call.__name__ = call.__qualname__ = function_name
+    return call
+
+
+enhance_allergy_intolerance_payload_to_fhir = _lazy('enhance_allergy_intolerance_payload', 'enhance_allergy_intolerance_payload_to_fhir')
+enhance_allergy_intolerance_payload_to_dict = _lazy('enhance_allergy_intolerance_payload', 'enhance_allergy_intolerance_payload_to_dict')
+get_allergy_intolerance_texts = _lazy('enhance_allergy_intolerance_payload', 'get_allergy_intolerance_texts')
+enhance_diagnostic_report_payload_to_fhir = _lazy('enhance_diagnostic_report_payload', 'enhance_diagnostic_report_payload_to_fhir')
+enhance_diagnostic_report_payload_to_dict = _lazy('enhance_diagnostic_report_payload', 'enhance_diagnostic_report_payload_to_dict')
+get_diagnostic_report_texts = _lazy('enhance_diagnostic_report_payload', 'get_diagnostic_report_texts')
+enhance_document_reference_payload_to_fhir = _lazy('enhance_document_reference_payload', 'enhance_document_reference_payload_to_fhir')
+enhance_document_reference_payload_to_dict = _lazy('enhance_document_reference_payload', 'enhance_document_reference_payload_to_dict')
+get_document_reference_texts = _lazy('enhance_document_reference_payload', 'get_document_reference_texts')
+enhance_immunization_payload_to_fhir = _lazy('enhance_immunization_payload', 'enhance_immunization_payload_to_fhir')
+enhance_immunization_payload_to_dict = _lazy('enhance_immunization_payload', 'enhance_immunization_payload_to_dict')
+get_immunization_texts = _lazy('enhance_immunization_payload', 'get_immunization_texts')
+
+__all__ = ['enhance_allergy_intolerance_payload_to_fhir', 'enhance_allergy_intolerance_payload_to_dict',
+           'get_allergy_intolerance_texts',
+           'enhance_diagnostic_report_payload_to_fhir', 'enhance_diagnostic_report_payload_to_dict',
+           'get_diagnostic_report_texts',
+           'enhance_document_reference_payload_to_fhir', 'enhance_document_reference_payload_to_dict',
+           'get_document_reference_texts',
+           'enhance_immunization_payload_to_fhir', 'enhance_immunization_payload_to_dict',
+           'get_immunization_texts',
+           'texts_to_analyze', 'enhance_to_dict']
+
+# Maps resource types to the function returning the texts their enhancement sends to NLP
+texts_to_analyze = {'AllergyIntolerance': get_allergy_intolerance_texts,
+                    'Immunization': get_immunization_texts,
+                    'DiagnosticReport': get_diagnostic_report_texts,
+                    'DocumentReference': get_document_reference_texts
+                    }
+
+# Maps resource types to the function enhancing their json objects without parsing the whole resource
+enhance_to_dict = {'AllergyIntolerance': enhance_allergy_intolerance_payload_to_dict,
+                   'Immunization': enhance_immunization_payload_to_dict,
+                   'DiagnosticReport': enhance_diagnostic_report_payload_to_dict,
+                   'DocumentReference': enhance_document_reference_payload_to_dict
+                   }
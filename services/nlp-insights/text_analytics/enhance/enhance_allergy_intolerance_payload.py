@@ -1,8 +1,10 @@
 import logging
 
 from fhir.resources.allergyintolerance import AllergyIntolerance
+from text_analytics import nlp_metrics
 from text_analytics.insights.add_insights_allergy import update_allergy_with_insights
 from text_analytics.insights.text_adjustments import adjust_allergy_text
+from text_analytics.utils import fhir_object_utils
 
 logger = logging.getLogger()
 
@@ -15,20 +17,84 @@ def enhance_allergy_intolerance_payload_to_fhir(nlp, input_json):
     """
 
     allergy_intolerance_fhir = AllergyIntolerance.parse_obj(input_json)
-    nlp_results = []
+    result_allergy = None
+    codeable_concepts = []
+    texts = []
 
     if allergy_intolerance_fhir.code and allergy_intolerance_fhir.code.text:
-        text = adjust_allergy_text(allergy_intolerance_fhir.code.text)
-        nlp_resp = nlp.process(text)
-        nlp_results.append([allergy_intolerance_fhir.code, nlp_resp])
+        codeable_concepts.append(allergy_intolerance_fhir.code)
+        texts.append(adjust_allergy_text(allergy_intolerance_fhir.code.text))
 
     if allergy_intolerance_fhir.reaction:
         for reaction in allergy_intolerance_fhir.reaction:
             for mf in reaction.manifestation:
-                nlp_resp = nlp.process(mf.text)
-                nlp_results.append([mf, nlp_resp])
+                if not mf.text:
+                    continue
+                codeable_concepts.append(mf)
+                texts.append(mf.text)
+
+    # analyze the code and all reaction manifestations concurrently
+    nlp_results = [[codeable_concept, nlp_resp]
+                   for codeable_concept, nlp_resp in zip(codeable_concepts, nlp.process_many(texts))]
 
     if nlp_results:
-        result_allergy = update_allergy_with_insights(nlp, allergy_intolerance_fhir, nlp_results)
+        with nlp_metrics.insight_build_seconds.time(resource_type='AllergyIntolerance'):
+            result_allergy = update_allergy_with_insights(nlp, allergy_intolerance_fhir, nlp_results)
 
     return result_allergy.json() if result_allergy else allergy_intolerance_fhir.json()
+
+
+def enhance_allergy_intolerance_payload_to_dict(nlp, input_json):
+    """
+    Given an NLP service and allergy intolerance (as json object), adds the insights to the
+    allergy intolerance json object and returns it.
+
+    Only code, reaction manifestations and meta are read, the rest of the allergy intolerance is not validated.
+    """
+    codeable_concepts = []  # pairs of json object and CodeableConcept
+    texts = []
+
+    code_json = input_json.get('code')
+    if code_json and code_json.get('text'):
+        codeable_concepts.append((code_json, fhir_object_utils.codeable_concept_from_json(code_json)))
+        texts.append(adjust_allergy_text(code_json['text']))
+
+    for reaction in input_json.get('reaction') or []:
+        for mf_json in reaction.get('manifestation') or []:
+            if not mf_json.get('text'):
+                continue
+            codeable_concepts.append((mf_json, fhir_object_utils.codeable_concept_from_json(mf_json)))
+            texts.append(mf_json.get('text'))
+
+    if not texts:
+        return input_json
+
+    # analyze the code and all reaction manifestations concurrently
+    nlp_results = [[codeable_concept, nlp_resp]
+                   for (codeable_concept_json, codeable_concept), nlp_resp in zip(codeable_concepts, nlp.process_many(texts))]
+
+    allergy_intolerance_fhir = AllergyIntolerance.construct(meta=fhir_object_utils.meta_from_json(input_json.get('meta')))
+    with nlp_metrics.insight_build_seconds.time(resource_type='AllergyIntolerance'):
+        if update_allergy_with_insights(nlp, allergy_intolerance_fhir, nlp_results):
+            for codeable_concept_json, codeable_concept in codeable_concepts:
+                fhir_object_utils.update_codeable_concept_json(codeable_concept_json, codeable_concept)
+            input_json['meta'] = allergy_intolerance_fhir.meta.dict()
+    return input_json
+
+
+def get_allergy_intolerance_texts(input_json):
+    """
+    Given an allergy intolerance (as json object), returns the texts that
+    enhance_allergy_intolerance_payload_to_fhir and _to_dict send to the NLP service.
+    """
+    texts = []
+    code_text = (input_json.get('code') or {}).get('text')
+    if code_text:
+        texts.append(adjust_allergy_text(code_text))
+
+    for reaction in input_json.get('reaction') or []:
+        for mf in reaction.get('manifestation') or []:
+            if mf.get('text'):
+                texts.append(mf['text'])
+
+    return texts
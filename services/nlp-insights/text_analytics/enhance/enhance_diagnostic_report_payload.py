@@ -2,6 +2,7 @@ import logging
 
 import collections
 from fhir.resources.diagnosticreport import DiagnosticReport
+from text_analytics import nlp_metrics
 from text_analytics.insights.add_insights_condition import create_conditions_from_insights
 from text_analytics.insights.add_insights_medication import create_med_statements_from_insights
 from text_analytics.insights.add_insights_medication import create_adverse_events_from_insights
@@ -15,16 +16,38 @@ def enhance_diagnostic_report_payload_to_fhir(nlp, diagnostic_report_json):
     a FHIR bundle resource with additional insights.
 
     """
+    diagnostic_report_fhir = DiagnosticReport.parse_obj(diagnostic_report_json)
+    text = fhir_object_utils.get_diagnostic_report_data(diagnostic_report_fhir)
+    bundle = _create_insights_bundle(nlp, diagnostic_report_fhir, text)
+
+    return bundle.json()
+
+
+def enhance_diagnostic_report_payload_to_dict(nlp, diagnostic_report_json):
+    """
+    Given an NLP service and diagnostic_report (as json object), returns a FHIR bundle resource
+    (as json object) with additional insights.
+
+    Only id, subject and the presented form are read, the diagnostic report is not validated.
+    """
+    diagnostic_report_fhir = DiagnosticReport.construct(id=diagnostic_report_json.get('id'),
+                                                        subject=diagnostic_report_json.get('subject'))
+    texts = get_diagnostic_report_texts(diagnostic_report_json)
+    bundle = _create_insights_bundle(nlp, diagnostic_report_fhir, texts[0] if texts else None)
+
+    return bundle.dict()
+
+
+def _create_insights_bundle(nlp, diagnostic_report_fhir, text):
     bundle_entries = []
     span_to_medref = collections.defaultdict(list)
 
-    diagnostic_report_fhir = DiagnosticReport.parse_obj(diagnostic_report_json)
-    text = fhir_object_utils.get_diagnostic_report_data(diagnostic_report_fhir)
     if text:
         nlp_resp = nlp.process(text)
-        create_conditions_fhir = create_conditions_from_insights(nlp, diagnostic_report_fhir, nlp_resp)
-        create_med_statements_fhir = create_med_statements_from_insights(nlp, diagnostic_report_fhir, nlp_resp, span_to_medref)
-        create_adverse_events_fhir = create_adverse_events_from_insights(nlp, diagnostic_report_fhir, nlp_resp, span_to_medref)
+        with nlp_metrics.insight_build_seconds.time(resource_type='DiagnosticReport'):
+            create_conditions_fhir = create_conditions_from_insights(nlp, diagnostic_report_fhir, nlp_resp)
+            create_med_statements_fhir = create_med_statements_from_insights(nlp, diagnostic_report_fhir, nlp_resp, span_to_medref)
+            create_adverse_events_fhir = create_adverse_events_from_insights(nlp, diagnostic_report_fhir, nlp_resp, span_to_medref)
 
         if create_conditions_fhir:
             for condition in create_conditions_fhir:
@@ -41,6 +64,14 @@ def enhance_diagnostic_report_payload_to_fhir(nlp, diagnostic_report_json):
                 bundle_entry = [adverse_event, 'POST', adverse_event.resource_type]
                 bundle_entries.append(bundle_entry)
 
-    bundle = fhir_object_utils.create_transaction_bundle(bundle_entries)
+    return fhir_object_utils.create_transaction_bundle(bundle_entries)
 
-    return bundle.json()
+
+def get_diagnostic_report_texts(diagnostic_report_json):
+    """
+    Given a diagnostic_report (as json object), returns the texts that
+    enhance_diagnostic_report_payload_to_fhir sends to the NLP service.
+    """
+    presented_form = diagnostic_report_json.get('presentedForm') or [None]
+    text = fhir_object_utils.decode_attachment_data(presented_form[0])
+    return [text] if text else []
@@ -1,6 +1,7 @@
 import logging
 
 from fhir.resources.documentreference import DocumentReference
+from text_analytics import nlp_metrics
 from text_analytics.insights.add_insights_condition import create_conditions_from_insights
 from text_analytics.insights.add_insights_medication import create_med_statements_from_insights
 from text_analytics.utils import fhir_object_utils
@@ -13,14 +14,36 @@ def enhance_document_reference_payload_to_fhir(nlp, document_reference_json):
     a FHIR bundle resource with additional insights.
 
     """
-    bundle_entries = []
-
     document_reference_fhir = DocumentReference.parse_obj(document_reference_json)
     text = fhir_object_utils.get_document_reference_data(document_reference_fhir)
+    bundle = _create_insights_bundle(nlp, document_reference_fhir, text)
+
+    return bundle.json()
+
+
+def enhance_document_reference_payload_to_dict(nlp, document_reference_json):
+    """
+    Given an NLP service and document_reference (as json object), returns a FHIR bundle resource
+    (as json object) with additional insights.
+
+    Only id, subject and the content attachment are read, the document reference is not validated.
+    """
+    document_reference_fhir = DocumentReference.construct(id=document_reference_json.get('id'),
+                                                          subject=document_reference_json.get('subject'))
+    texts = get_document_reference_texts(document_reference_json)
+    bundle = _create_insights_bundle(nlp, document_reference_fhir, texts[0] if texts else None)
+
+    return bundle.dict()
+
+
+def _create_insights_bundle(nlp, document_reference_fhir, text):
+    bundle_entries = []
+
     if text:
         nlp_resp = nlp.process(text)
-        create_conditions_fhir = create_conditions_from_insights(nlp, document_reference_fhir, nlp_resp)
-        create_med_statements_fhir = create_med_statements_from_insights(nlp, document_reference_fhir, nlp_resp)
+        with nlp_metrics.insight_build_seconds.time(resource_type='DocumentReference'):
+            create_conditions_fhir = create_conditions_from_insights(nlp, document_reference_fhir, nlp_resp)
+            create_med_statements_fhir = create_med_statements_from_insights(nlp, document_reference_fhir, nlp_resp, None)
 
         if create_conditions_fhir:
             for condition in create_conditions_fhir:
@@ -32,6 +55,14 @@ def enhance_document_reference_payload_to_fhir(nlp, document_reference_json):
                 bundle_entry = [med_statement, 'POST', med_statement.resource_type]
                 bundle_entries.append(bundle_entry)
 
-    bundle = fhir_object_utils.create_transaction_bundle(bundle_entries)
+    return fhir_object_utils.create_transaction_bundle(bundle_entries)
 
-    return bundle.json()
+
+def get_document_reference_texts(document_reference_json):
+    """
+    Given a document_reference (as json object), returns the texts that
+    enhance_document_reference_payload_to_fhir sends to the NLP service.
+    """
+    content = document_reference_json.get('content') or [None]
+    text = fhir_object_utils.decode_attachment_data((content[0] or {}).get('attachment'))
+    return [text] if text else []
@@ -1,8 +1,10 @@
 import logging
 
 from fhir.resources.immunization import Immunization
+from text_analytics import nlp_metrics
 from text_analytics.insights.add_insights_immunization import update_immunization_with_insights
 from text_analytics.insights.text_adjustments import adjust_vaccine_text
+from text_analytics.utils import fhir_object_utils
 
 logger = logging.getLogger()
 
@@ -20,6 +22,38 @@ def enhance_immunization_payload_to_fhir(nlp, immunization_json):
     if immunization_fhir.vaccineCode.text:
         text = adjust_vaccine_text(immunization_fhir.vaccineCode.text)
         nlp_resp = nlp.process(text)
-        updated_immunization = update_immunization_with_insights(nlp, immunization_fhir, nlp_resp)
+        with nlp_metrics.insight_build_seconds.time(resource_type='Immunization'):
+            updated_immunization = update_immunization_with_insights(nlp, immunization_fhir, nlp_resp)
 
     return updated_immunization.json() if updated_immunization else immunization_fhir.json()
+
+
+def enhance_immunization_payload_to_dict(nlp, immunization_json):
+    """
+    Given an NLP service and immunization (as json object), adds the insights to the
+    immunization json object and returns it.
+
+    Only vaccineCode and meta are read, the rest of the immunization is not validated.
+    """
+    vaccine_code_json = immunization_json.get('vaccineCode')
+    if not vaccine_code_json or not vaccine_code_json.get('text'):
+        return immunization_json
+
+    immunization_fhir = Immunization.construct(vaccineCode=fhir_object_utils.codeable_concept_from_json(vaccine_code_json),
+                                               meta=fhir_object_utils.meta_from_json(immunization_json.get('meta')))
+    text = adjust_vaccine_text(vaccine_code_json['text'])
+    nlp_resp = nlp.process(text)
+    with nlp_metrics.insight_build_seconds.time(resource_type='Immunization'):
+        if update_immunization_with_insights(nlp, immunization_fhir, nlp_resp):
+            fhir_object_utils.update_codeable_concept_json(vaccine_code_json, immunization_fhir.vaccineCode)
+            immunization_json['meta'] = immunization_fhir.meta.dict()
+    return immunization_json
+
+
+def get_immunization_texts(immunization_json):
+    """
+    Given an immunization (as json object), returns the texts that
+    enhance_immunization_payload_to_fhir sends to the NLP service.
+    """
+    vaccine_text = (immunization_json.get('vaccineCode') or {}).get('text')
+    return [adjust_vaccine_text(vaccine_text)] if vaccine_text else []
@@ -3,38 +3,41 @@ from fhir.resources.condition import Condition
 from fhir.resources.extension import Extension
 
 from text_analytics.insights import insight_constants
+from text_analytics.insights.concept_records import get_concept_records, type_mask
 from text_analytics.utils import fhir_object_utils
 
+CONDITION_TYPES = type_mask(["ICDiagnosis", 'umls.DiseaseOrSyndrome', 'umls.PathologicFunction', 'umls.SignOrSymptom', 'umls.NeoplasticProcess',
+                             'umls.CellOrMolecularDysfunction', 'umls.MentalOrBehavioralDysfunction'])
+
 
 def _build_resource(nlp, diagnostic_report, nlp_output):
     nlp_name = type(nlp).__name__
-    nlp_concepts = nlp_output.get('concepts')
     conditions_found = {}            # key is UMLS ID, value is the FHIR resource
     conditions_insight_counter = {}  # key is UMLS ID, value is the current insight_id_num
-    for concept in nlp_concepts:
-        the_type = concept['type']
-        if isinstance(the_type, str):
-            the_type = [the_type]
-        if len(set(the_type) & set(["ICDiagnosis", 'umls.DiseaseOrSyndrome', 'umls.PathologicFunction', 'umls.SignOrSymptom', 'umls.NeoplasticProcess',
-        'umls.CellOrMolecularDysfunction', 'umls.MentalOrBehavioralDysfunction'])) > 0:
+    conditions_codings = {}          # key is UMLS ID, value is the index of the codings of the condition code
+    for concept_record in get_concept_records(nlp_output):
+        if concept_record.type_mask & CONDITION_TYPES:
+            concept = concept_record.concept
             condition = conditions_found.get(concept["cui"])
             if condition is None:
                 condition = Condition.construct()
                 condition.meta = fhir_object_utils.add_resource_meta_unstructured(nlp, diagnostic_report)
                 conditions_found[concept["cui"]] = condition
+                conditions_codings[concept["cui"]] = {}
                 insight_id_num = 1
             else:
                 insight_id_num = conditions_insight_counter[concept["cui"]] + 1
             conditions_insight_counter[concept["cui"]] = insight_id_num
             insight_id_string = "insight-" + str(insight_id_num)
-            _build_resource_data(condition, concept, insight_id_string)
+            _build_resource_data(condition, concept, insight_id_string, conditions_codings[concept["cui"]])
 
             insight = Extension.construct()
             insight.url = insight_constants.INSIGHT_INSIGHT_ENTRY_URL
 
             insight_id_ext = fhir_object_utils.create_insight_extension(insight_id_string, insight_constants.INSIGHT_ID_UNSTRUCTURED_SYSTEM)
             insight.extension = [insight_id_ext]
-            insight_detail = fhir_object_utils.create_insight_detail_extension(nlp_output)
+            insight_detail = fhir_object_utils.create_insight_detail_extension(nlp_output, reference=insight_id_num > 1,
+                                                                              encodings=nlp.evidence_encodings)
             insight.extension.append(insight_detail)
             insight_span = fhir_object_utils.create_insight_span_extension(concept)
             insight.extension.append(insight_span)
@@ -48,13 +51,13 @@ def _build_resource(nlp, diagnostic_report, nlp_output):
     return list(conditions_found.values())
 
 
-def _build_resource_data(condition, concept, insight_id):
+def _build_resource_data(condition, concept, insight_id, codings=None):
     if condition.code is None:
         codeable_concept = CodeableConcept.construct()
         codeable_concept.text = concept["preferredName"]
         condition.code = codeable_concept
         codeable_concept.coding = []
-    fhir_object_utils.add_codings(concept, condition.code, insight_id, insight_constants.INSIGHT_ID_UNSTRUCTURED_SYSTEM)
+    fhir_object_utils.add_codings(concept, condition.code, insight_id, insight_constants.INSIGHT_ID_UNSTRUCTURED_SYSTEM, codings)
 
 
 def create_conditions_from_insights(nlp, diagnostic_report, nlp_output):
@@ -1,12 +1,15 @@
 import logging
 
 from text_analytics.insights import insight_constants
+from text_analytics.insights.concept_records import get_concept_records, type_mask
 from text_analytics.utils import fhir_object_utils
 from fhir.resources.extension import Extension
 from fhir.resources.codeableconcept import CodeableConcept
 
 logger = logging.getLogger()
 
+IMMUNIZATION_TYPES = type_mask(["ICMedication", "umls.ImmunologicFactor"])
+
 """
 Parameters:
   immunization: FHIR immunization resource object that is updated
@@ -15,43 +18,44 @@ Returns the updated resource if any insights were added to it.  Returns None if
 """
 def update_immunization_with_insights(nlp, immunization, nlp_results):
     insight_num = 0
-    concepts = nlp_results["concepts"]
-    if concepts is not None:
-        for concept in concepts:
-            the_type = concept['type']
-            if isinstance(the_type, str):
-                the_type = [the_type]
-            if len(set(the_type) & set(["ICMedication", "umls.ImmunologicFactor"])) > 0:
-                # Add a new insight
-                insight_num = insight_num + 1
-                insight_id = "insight-" + str(insight_num)
+    codings = None  # index of the codings of the vaccine code while insights are added
+    for concept_record in get_concept_records(nlp_results):
+        if concept_record.type_mask & IMMUNIZATION_TYPES:
+            concept = concept_record.concept
+            # Add a new insight
+            insight_num = insight_num + 1
+            insight_id = "insight-" + str(insight_num)
 
-                if immunization.vaccineCode is None:
-                    codeable_concept = CodeableConcept.construct()
-                    codeable_concept.text = concept["preferredName"]
-                    immunization.vaccineCode = codeable_concept
-                    codeable_concept.coding = []
-                fhir_object_utils.add_codings(concept, immunization.vaccineCode, insight_id, insight_constants.INSIGHT_ID_STRUCTURED_SYSTEM)
+            if immunization.vaccineCode is None:
+                codeable_concept = CodeableConcept.construct()
+                codeable_concept.text = concept["preferredName"]
+                immunization.vaccineCode = codeable_concept
+                codeable_concept.coding = []
+            if codings is None:
+                codings = fhir_object_utils.index_codings(immunization.vaccineCode)
+            fhir_object_utils.add_codings(concept, immunization.vaccineCode, insight_id, insight_constants.INSIGHT_ID_STRUCTURED_SYSTEM,
+                                          codings)
 
-                # Create insight for resource level extension
-                insight = Extension.construct()
-                insight.url = insight_constants.INSIGHT_INSIGHT_ENTRY_URL
-                insight_id_ext = fhir_object_utils.create_insight_extension(insight_id, insight_constants.INSIGHT_ID_STRUCTURED_SYSTEM)
-                insight.extension = [insight_id_ext]
-                # Save ACD response
-                insight_detail = fhir_object_utils.create_insight_detail_extension(nlp_results)
-                insight.extension.append(insight_detail)
+            # Create insight for resource level extension
+            insight = Extension.construct()
+            insight.url = insight_constants.INSIGHT_INSIGHT_ENTRY_URL
+            insight_id_ext = fhir_object_utils.create_insight_extension(insight_id, insight_constants.INSIGHT_ID_STRUCTURED_SYSTEM)
+            insight.extension = [insight_id_ext]
+            # Save ACD response
+            insight_detail = fhir_object_utils.create_insight_detail_extension(nlp_results, reference=insight_num > 1,
+                                                                          encodings=nlp.evidence_encodings)
+            insight.extension.append(insight_detail)
 
-                # Add meta if any insights were added
-                fhir_object_utils.add_resource_meta_structured(nlp, immunization)
-                if immunization.meta.extension is None:
-                    ext = Extension.construct()
-                    ext.url = insight_constants.INSIGHT_RESULT_URL
-                    immunization.meta.extension = [ext]
-                result_extension = immunization.meta.extension[0]
-                if result_extension.extension is None:
-                    result_extension.extension = []
-                result_extension.extension.append(insight)
+            # Add meta if any insights were added
+            fhir_object_utils.add_resource_meta_structured(nlp, immunization)
+            if immunization.meta.extension is None:
+                ext = Extension.construct()
+                ext.url = insight_constants.INSIGHT_RESULT_URL
+                immunization.meta.extension = [ext]
+            result_extension = immunization.meta.extension[0]
+            if result_extension.extension is None:
+                result_extension.extension = []
+            result_extension.extension.append(insight)
 
     if insight_num == 0:  # No insights found
         return None
@@ -15,6 +15,7 @@ from fhir.resources.adverseevent import AdverseEventSuspectEntityCausality
 from fhir.resources.quantity import Quantity
 from fhir.resources.timing import Timing
 from text_analytics.insights import insight_constants
+from text_analytics.insights.concept_records import get_concept_records, type_mask
 from text_analytics.utils import fhir_object_utils
 
 logger = logging.getLogger()
@@ -53,26 +54,33 @@ def _create_adverse_event_from_template(condition_name, code, source, is_confirm
     med_statement = AdverseEvent.construct(**med_statement_template)
     return med_statement
 
+
+MEDICATION_TYPES = type_mask(['umls.Antibiotic', 'umls.ClinicalDrug', 'umls.PharmacologicSubstance', 'umls.OrganicChemical'])
+
+
 def _build_resource(nlp, diagnostic_report, nlp_output, span_to_medref = None):
-    concepts = nlp_output.get('concepts')
     med_statements_found = {}            # key is UMLS ID, value is the FHIR resource
     med_statements_insight_counter = {}  # key is UMLS ID, value is the current insight_num
 
     if hasattr(nlp, 'add_medications'):
         med_statements_found, med_statements_insight_counter = nlp.add_medications(nlp, diagnostic_report, nlp_output, med_statements_found, med_statements_insight_counter, span_to_medref)
 
-    for concept in concepts:
-        the_type = concept['type']
-        if isinstance(the_type, str):
-            the_type = [the_type]
-        if len(set(the_type) & set(['umls.Antibiotic', 'umls.ClinicalDrug', 'umls.PharmacologicSubstance', 'umls.OrganicChemical'])) > 0:
-            med_statements_found, med_statements_insight_counter = create_insight(concept, nlp, nlp_output, diagnostic_report, _build_resource_data, med_statements_found, med_statements_insight_counter, span_to_medref)
+    coding_indexes = {}  # key is UMLS ID, value is the index of the codings of the medication code
+    for concept_record in get_concept_records(nlp_output):
+        if concept_record.type_mask & MEDICATION_TYPES:
+            concept = concept_record.concept
+            med_statements_found, med_statements_insight_counter = create_insight(concept, nlp, nlp_output, diagnostic_report, _build_resource_data, med_statements_found, med_statements_insight_counter, span_to_medref, coding_indexes)
 
     if len(med_statements_found) == 0:
         return None
     return list(med_statements_found.values())
 
-def create_insight(concept, nlp, nlp_output, diagnostic_report, build_resource, med_statements_found, med_statements_insight_counter, span_to_med_refs=None):
+def create_insight(concept, nlp, nlp_output, diagnostic_report, build_resource, med_statements_found, med_statements_insight_counter, span_to_med_refs=None, coding_indexes=None):
+    """
+    Adds an insight for the concept to the medication statement of its UMLS ID, creating the statement the
+    first time.  coding_indexes optionally keeps the index of the codings of each statement's medication
+    code (UMLS ID -> index, see fhir_object_utils.index_codings) between calls.
+    """
     cui = concept.get('cui')
     med_statement = med_statements_found.get(cui)
     if med_statement is None:
@@ -84,12 +92,18 @@ def create_insight(concept, nlp, nlp_output, diagnostic_report, build_resource,
         insight_num = med_statements_insight_counter[cui] + 1
     med_statements_insight_counter[cui] = insight_num
     insight_id = "insight-" + str(insight_num)
-    build_resource(med_statement, concept, insight_id)
+    codings = None
+    if coding_indexes is not None:
+        codings = coding_indexes.get(cui)
+        if codings is None:  # statement created here, or by an earlier builder of the same report
+            codings = coding_indexes[cui] = fhir_object_utils.index_codings(med_statement.medicationCodeableConcept)
+    build_resource(med_statement, concept, insight_id, codings)
     insight = Extension.construct()
     insight.url = insight_constants.INSIGHT_INSIGHT_ENTRY_URL
     insight_id_ext = fhir_object_utils.create_insight_extension(insight_id, insight_constants.INSIGHT_ID_UNSTRUCTURED_SYSTEM)
     insight.extension = [insight_id_ext]
-    insight_detail = fhir_object_utils.create_insight_detail_extension(nlp_output)
+    insight_detail = fhir_object_utils.create_insight_detail_extension(nlp_output, reference=insight_num > 1,
+                                                                      encodings=nlp.evidence_encodings)
     insight.extension.append(insight_detail)
     insight_span = fhir_object_utils.create_insight_span_extension(concept)
     insight.extension.append(insight_span)
@@ -105,7 +119,7 @@ def create_insight(concept, nlp, nlp_output, diagnostic_report, build_resource,
 
     return med_statements_found, med_statements_insight_counter
 
-def _build_resource_data(med_statement, concept, insight_id):
+def _build_resource_data(med_statement, concept, insight_id, codings=None):
     if med_statement.status is None:
         med_statement.status = 'unknown'
 
@@ -117,7 +131,7 @@ def _build_resource_data(med_statement, concept, insight_id):
         med_statement.medicationCodeableConcept = codeable_concept
         codeable_concept.coding = []
 
-    fhir_object_utils.add_codings_drug(concept, drug, med_statement.medicationCodeableConcept, insight_id, insight_constants.INSIGHT_ID_UNSTRUCTURED_SYSTEM)
+    fhir_object_utils.add_codings_drug(concept, drug, med_statement.medicationCodeableConcept, insight_id, insight_constants.INSIGHT_ID_UNSTRUCTURED_SYSTEM, codings)
 
 
 def create_med_statements_from_insights(nlp, diagnostic_report, nlp_output, span_to_medref):
@@ -145,12 +159,12 @@ def multi_stage_getattr(root_object, *keys):
 
 def create_adverse_events_from_insights(nlp, diagnostic_report, nlp_output, span_to_medref):
     uid_to_covered_text = {}
-    for sentence in nlp_output['sentences']:
+    for sentence in nlp_output.get('sentences', []):  # only ACD returns sentences and attribute values
         if 'uid' in sentence:
             uid_to_covered_text[sentence['uid']] = sentence['coveredText']
 
     adverse_events = []
-    for adverse_event_attr in nlp_output['attributeValues']:
+    for adverse_event_attr in nlp_output.get('attributeValues', []):
         begin, end = adverse_event_attr['begin'], adverse_event_attr['end']
         evidence_uid = adverse_event_attr.get('evidenceSpans', [{'uid':None}])[0]['uid']
         evidence = uid_to_covered_text.get(evidence_uid, "Not available")
@@ -0,0 +1,63 @@
+import threading
+
+_type_bits = {}  # semantic type name -> bit of the type in masks
+_type_bits_lock = threading.Lock()
+
+
+class ConceptRecord:
+    """A concept of an NLP response with its semantic types as a bitmask, see type_mask()"""
+
+    __slots__ = ('concept', 'type_mask')
+
+    def __init__(self, concept, type_mask):
+        self.concept = concept
+        self.type_mask = type_mask
+
+
+def type_bit(type_name):
+    """Returns the bit for a semantic type name, assigning the next free bit to names not seen before"""
+    bit = _type_bits.get(type_name)
+    if bit is None:
+        with _type_bits_lock:
+            bit = _type_bits.setdefault(type_name, 1 << len(_type_bits))
+    return bit
+
+
+def type_mask(types):
+    """
+    Returns the bitmask of semantic type names: a list of names, a single name (str) or None.
+    Concepts of a type filter have a type in common with it when (concept mask & filter mask) != 0.
+    """
+    if types is None:
+        return 0
+    if isinstance(types, str):
+        return type_bit(types)
+    mask = 0
+    for type_name in types:
+        mask |= type_bit(type_name)
+    return mask
+
+
+class NLPResponse(dict):
+    """
+    An NLP response (json object) with a ConceptRecord for each of its concepts, in order.
+    NLP services return their responses as these (see NLPService), so the records are created once,
+    where the response is produced, and go wherever the response goes.
+    """
+
+    __slots__ = ('concept_records',)
+
+    def __init__(self, response):
+        super().__init__(response)
+        self.concept_records = _create_concept_records(self)
+
+
+def get_concept_records(nlp_output):
+    """Returns a ConceptRecord for each concept of the NLP output, in order"""
+    if isinstance(nlp_output, NLPResponse):
+        return nlp_output.concept_records
+    return _create_concept_records(nlp_output)  # not from an NLP service
+
+
+def _create_concept_records(nlp_output):
+    return [ConceptRecord(concept, type_mask(concept.get('type'))) for concept in nlp_output.get('concepts') or []]
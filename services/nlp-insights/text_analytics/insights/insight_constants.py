@@ -17,6 +17,7 @@ INSIGHT_SPAN_COVERED_TEXT_URL = "http://ibm.com/fhir/cdm/insight/covered-text"
 INSIGHT_CONFIDENCE_URL = "http://ibm.com/fhir/cdm/insight/confidence"              # confidence (general, complex extension)
 INSIGHT_CONFIDENCE_SCORE_URL = "http://ibm.com/fhir/cdm/insight/confidence-score"  # confidence score for the insight
 INSIGHT_CONFIDENCE_NAME_URL = "http://ibm.com/fhir/cdm/insight/confidence-name"    # name of the specific confidence score
+INSIGHT_FINGERPRINT_URL = "http://ibm.com/fhir/cdm/insight/fingerprint"          # hash of the analyzed texts and the config
 
 # Extension URLs used within standard FHIR resource fields (extensions within a nested field of a FHIR resource)
 # also see INSIGHT_REFERENCE_URL, INSIGHT_CLASSIFICATION_URL
@@ -0,0 +1,56 @@
+import hashlib
+
+from text_analytics.enhance import texts_to_analyze
+from text_analytics.insights import insight_constants
+
+
+def resource_fingerprint(config, resource):
+    """
+    Returns a fingerprint of what enhancing the resource (as json object) would analyze: the process
+    version, the definition of the config that analyzes it and its texts.  Returns None for resources
+    the config snapshot does not enhance.
+    """
+    resource_type = resource['resourceType']
+    nlp_service = config.service_for(resource_type)
+    get_texts = texts_to_analyze.get(resource_type)
+    if nlp_service is None or resource_type not in nlp_service.types_can_handle or get_texts is None:
+        return None
+    digest = hashlib.sha256()
+    digest.update(insight_constants.PROCESS_VERSION.encode('utf-8') + b'\0')
+    digest.update(nlp_service.config_version.encode('utf-8') + b'\0')
+    for text in get_texts(resource):
+        data = text if isinstance(text, bytes) else text.encode('utf-8')
+        digest.update(b'%d:' % len(data) + data)  # length prefixed, so texts cannot run into each other
+    return digest.hexdigest()
+
+
+def get_fingerprint(resource):
+    """Returns the fingerprint saved in the insight result meta of the resource, if it was added by this process version"""
+    result_extension = _result_extension(resource)
+    if result_extension is None:
+        return None
+    values = {extension.get('url'): extension.get('valueString') for extension in result_extension.get('extension') or []}
+    if values.get(insight_constants.PROCESS_VERSION_URL) != insight_constants.PROCESS_VERSION:
+        return None
+    return values.get(insight_constants.INSIGHT_FINGERPRINT_URL)
+
+
+def set_fingerprint(resource, fingerprint):
+    """
+    Saves the fingerprint in the insight result meta of an enhanced resource (as json object), replacing
+    the one of an earlier run.  Resources without insight result meta (no insights found) are not changed.
+    """
+    result_extension = _result_extension(resource)
+    if result_extension is None:
+        return
+    extensions = [extension for extension in result_extension.get('extension') or []
+                  if extension.get('url') != insight_constants.INSIGHT_FINGERPRINT_URL]
+    extensions.append({'url': insight_constants.INSIGHT_FINGERPRINT_URL, 'valueString': fingerprint})
+    result_extension['extension'] = extensions
+
+
+def _result_extension(resource):
+    for extension in (resource.get('meta') or {}).get('extension') or []:
+        if extension.get('url') == insight_constants.INSIGHT_RESULT_URL:
+            return extension
+    return None
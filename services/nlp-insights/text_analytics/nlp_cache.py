@@ -0,0 +1,144 @@
+import collections
+import hashlib
+import os
+import threading
+import time
+
+from concurrent.futures import Future
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+from text_analytics import nlp_deadline
+from text_analytics.utils import fast_json
+
+
+class NLPResponseCache:
+    """
+    Size bounded LRU cache of NLP responses with a time to live.
+
+    The cache is bounded both by number of entries and by the (approximate) serialized size of
+    the responses it holds.  Least recently used entries are evicted when either bound is hit,
+    and entries older than ttl seconds are dropped when they are next looked up.
+    Concurrent misses for the same key are coalesced into a single call to the NLP engine.
+
+    Cached responses are shared between callers and must not be modified.
+    """
+
+    def __init__(self, max_entries, max_bytes, ttl):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries = collections.OrderedDict()  # key -> (expiry time, size, response)
+        self._loading = {}  # key -> Future for responses being loaded
+        self._lock = threading.Lock()
+        self.size_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @staticmethod
+    def make_key(config_name, config_version, text):
+        """
+        Returns the cache key for a text analyzed by a config.
+        The text is normalized to a str (some callers pass utf-8 bytes) but is otherwise kept as is,
+        since NLP responses contain offsets into the exact text that was analyzed.
+        """
+        if isinstance(text, bytes):
+            text = text.decode('utf-8')
+        text_hash = hashlib.sha256(text.encode('utf-8')).hexdigest()
+        return (config_name, config_version, text_hash)
+
+    def get(self, key):
+        """Returns the cached response for the key, or None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expiry, size, response = entry
+            if expiry < time.monotonic():
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return response
+
+    def get_or_load(self, key, load):
+        """
+        Returns the cached response for the key.  On a miss the response is loaded by calling load()
+        and added to the cache; callers missing on a key that is already being loaded wait for that load,
+        until the deadline of their request.
+        """
+        response = self.get(key)
+        if response is not None:
+            return response
+
+        with self._lock:
+            pending = self._loading.get(key)
+            is_loader = pending is None
+            if is_loader:
+                pending = Future()
+                self._loading[key] = pending
+        if not is_loader:
+            try:
+                return pending.result(timeout=nlp_deadline.remaining())
+            except FutureTimeoutError:
+                raise nlp_deadline.DeadlineExceeded("request deadline exceeded waiting for the same text")
+
+        try:
+            response = load()
+            self.put(key, response)
+            pending.set_result(response)
+            return response
+        except BaseException as ex:
+            pending.set_exception(ex)
+            raise
+        finally:
+            with self._lock:
+                del self._loading[key]
+
+    def put(self, key, response):
+        """Adds a response to the cache, evicting least recently used entries as needed"""
+        size = len(fast_json.dumps_bytes(response))
+        if size > self.max_bytes or self.max_entries <= 0:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.monotonic() + self.ttl, size, response)
+            self.size_bytes += size
+            while len(self._entries) > self.max_entries or self.size_bytes > self.max_bytes:
+                oldest_key = next(iter(self._entries))
+                self._remove(oldest_key)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size_bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"entries": len(self._entries),
+                    "bytes": self.size_bytes,
+                    "maxEntries": self.max_entries,
+                    "maxBytes": self.max_bytes,
+                    "ttlSeconds": self.ttl,
+                    "hits": self.hits,
+                    "misses": self.misses,
+                    "hitRate": self.hits / lookups if lookups else 0.0,
+                    "evictions": self.evictions,
+                    "expirations": self.expirations}
+
+    def _remove(self, key):
+        expiry, size, response = self._entries.pop(key)
+        self.size_bytes -= size
+
+
+# Cache shared by all configured NLP services
+response_cache = NLPResponseCache(max_entries=int(os.getenv("NLP_CACHE_MAX_ENTRIES", "10000")),
+                                  max_bytes=int(os.getenv("NLP_CACHE_MAX_BYTES", str(256 * 1024 * 1024))),
+                                  ttl=float(os.getenv("NLP_CACHE_TTL_SECONDS", "3600")))
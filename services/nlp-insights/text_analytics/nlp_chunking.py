@@ -0,0 +1,110 @@
+import os
+import re
+
+# Texts longer than this many characters are analyzed in chunks (0 analyzes every text whole),
+# unless a config sets its own chunkSize
+default_chunk_size = int(os.getenv("NLP_CHUNK_SIZE", "0"))
+# Characters of text that consecutive chunks share, so concepts at a chunk boundary are seen whole
+default_chunk_overlap = int(os.getenv("NLP_CHUNK_OVERLAP", "200"))
+
+# End of a sentence (with any closing quotes or brackets) and the spacing after it, or a line break
+SENTENCE_END = re.compile(r"[.!?][\"')\]]*\s+|\n")
+
+
+def split_text(text, size, overlap):
+    """
+    Splits the text into chunks of at most size characters, as a list of (offset in text, chunk).
+
+    Chunks end at a paragraph break, else at the end of a sentence, else at a space, searched for
+    in the second half of the window.  Each chunk after the first starts at the last sentence (else
+    word) of the chunk before it that begins overlap to twice overlap characters before that chunk ends.
+    """
+    if size <= 0 or len(text) <= size:
+        return [(0, text)]
+    overlap = min(overlap, size // 2)
+    chunks = []
+    start = end = 0
+    while len(text) - start > size:
+        end = _chunk_end(text, max(start + size // 2, end + 1), start + size)  # past the end of the last chunk
+        chunks.append((start, text[start:end]))
+        start = _chunk_start(text, max(end - 2 * overlap, start + 1), max(end - overlap, start + 1))
+    chunks.append((start, text[start:]))
+    return chunks
+
+
+def _chunk_end(text, low, high):
+    paragraph = text.rfind("\n\n", low, high)
+    if paragraph >= 0:
+        return paragraph + 2
+    sentence_end = None
+    for match in SENTENCE_END.finditer(text, low, high):
+        sentence_end = match.end()
+    if sentence_end is not None:
+        return sentence_end
+    space = text.rfind(" ", low, high)
+    return space + 1 if space >= 0 else high
+
+
+def _chunk_start(text, low, high):
+    sentence_start = None
+    for match in SENTENCE_END.finditer(text, low, high):
+        sentence_start = match.end()
+    if sentence_start is not None:
+        return sentence_start
+    space = text.rfind(" ", low, high)
+    return space + 1 if space >= 0 else high
+
+
+def merge_responses(chunks, responses):
+    """
+    Merges the NLP responses of the chunks from split_text() into one response for the whole text.
+
+    Offsets (begin and end) are shifted by the offset of their chunk, and uids are renumbered so
+    the uids of different chunks do not collide.  The overlap of two chunks is split in the middle:
+    annotations that begin in the first half are kept from the earlier chunk and the others from
+    the later chunk, so a concept found by both chunks is only kept once.  Values that are not
+    lists of annotations are taken from the first chunk that has them.
+    The responses are not modified.
+    """
+    merged = {}
+    uid_base = 0
+    for index, ((offset, chunk), response) in enumerate(zip(chunks, responses)):
+        owned_begin = 0 if index == 0 else _overlap_middle(chunks[index - 1], offset)
+        owned_end = None if index == len(chunks) - 1 else _overlap_middle(chunks[index], chunks[index + 1][0])
+        uids = [uid_base - 1]
+        shifted = _shift(response, offset, uid_base, uids)
+        for key, value in shifted.items():
+            if not isinstance(value, list):
+                merged.setdefault(key, value)
+                continue
+            annotations = merged.setdefault(key, [])
+            for annotation in value:
+                begin = annotation.get('begin') if isinstance(annotation, dict) else None
+                if not isinstance(begin, int) or \
+                        (begin >= owned_begin and (owned_end is None or begin < owned_end)):
+                    annotations.append(annotation)
+        uid_base = max(uids) + 1
+    return merged
+
+
+def _overlap_middle(chunk, next_offset):
+    offset, text = chunk
+    return (next_offset + offset + len(text)) // 2
+
+
+def _shift(value, offset, uid_base, uids):
+    """Returns a copy of the json value with its offsets shifted and its uids renumbered"""
+    if isinstance(value, dict):
+        shifted = {}
+        for key, item in value.items():
+            if key in ('begin', 'end') and type(item) is int:
+                shifted[key] = item + offset
+            elif key == 'uid' and type(item) is int:
+                shifted[key] = item + uid_base
+                uids.append(shifted[key])
+            else:
+                shifted[key] = _shift(item, offset, uid_base, uids)
+        return shifted
+    if isinstance(value, list):
+        return [_shift(item, offset, uid_base, uids) for item in value]
+    return value
@@ -0,0 +1,58 @@
+import collections
+import threading
+
+from types import MappingProxyType
+
+
+class NLPConfig(collections.namedtuple('NLPConfig', ['default_name', 'services', 'overrides'])):
+    """
+    Immutable snapshot of the configured NLP services.
+
+    default_name - name of the default config, or None
+    services - read-only map of config name to NLP service instance
+    overrides - read-only map of resource type to config name
+
+    A snapshot is never modified; config changes publish a new snapshot instead, so a request
+    can route all of its resources with the snapshot it started with and without any locking.
+    """
+    __slots__ = ()
+
+    @property
+    def default_service(self):
+        if self.default_name is None:
+            return None
+        return self.services.get(self.default_name)
+
+    def service_for(self, resource_type):
+        """Returns the NLP service that handles the given resource type"""
+        if resource_type in self.overrides:
+            return self.services[self.overrides[resource_type]]
+        return self.default_service
+
+    def replace(self, **changes):
+        """Returns a new snapshot with the given fields changed (maps are copied and frozen)"""
+        for field in ('services', 'overrides'):
+            if field in changes:
+                changes[field] = MappingProxyType(dict(changes[field]))
+        return self._replace(**changes)
+
+
+EMPTY_CONFIG = NLPConfig(None, MappingProxyType({}), MappingProxyType({}))
+
+
+class NLPConfigHolder:
+    """
+    Holds the current NLP config snapshot.
+
+    Readers just use `current`.  Writers hold `lock` while they read the current snapshot,
+    validate their change against it and publish the replacement, so concurrent config
+    updates do not lose each other's changes.
+    """
+
+    def __init__(self, config=EMPTY_CONFIG):
+        self.current = config
+        self.lock = threading.RLock()
+
+    def publish(self, config):
+        self.current = config
+        return config
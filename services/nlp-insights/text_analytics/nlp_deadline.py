@@ -0,0 +1,59 @@
+"""
+Time budget of a request, passed on to the NLP engine calls made for it.
+
+The deadline is kept in a context variable, so it follows the request into the worker threads that
+run with a copy of its context (contextvars.copy_context().run).  Engine calls use the remaining
+time as their timeout and are not started once it is used up.
+"""
+import contextlib
+import contextvars
+import os
+import time
+
+# Seconds a /discoverInsights request may take when it does not set its own deadline (0: no deadline)
+default_deadline_seconds = float(os.getenv("NLP_REQUEST_DEADLINE_SECONDS", "0"))
+
+# time.monotonic() by which the current request must be answered, or None
+_deadline = contextvars.ContextVar('nlp_deadline', default=None)
+
+
+class DeadlineExceeded(TimeoutError):
+    """Raised instead of calling an NLP engine when the deadline of the request has passed"""
+    pass
+
+
+@contextlib.contextmanager
+def deadline_after(seconds):
+    """Sets the deadline of the code in the with block to seconds from now (None or 0: no deadline)"""
+    token = _deadline.set(time.monotonic() + seconds if seconds else None)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining():
+    """Returns the seconds left until the deadline, or None when there is no deadline"""
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+def exceeded():
+    left = remaining()
+    return left is not None and left <= 0
+
+
+def check(needed=0.0):
+    """Raises DeadlineExceeded unless more than needed seconds are left"""
+    left = remaining()
+    if left is not None and left <= needed:
+        raise DeadlineExceeded("request deadline exceeded")
+
+
+def timeout(seconds):
+    """Returns the timeout for a call that would otherwise wait up to seconds, raising DeadlineExceeded when no time is left"""
+    check()
+    left = remaining()
+    return seconds if left is None or (seconds is not None and seconds < left) else left
@@ -0,0 +1,215 @@
+"""
+Adaptive concurrency limit and circuit breaker for the calls of an NLP config to its engine.
+
+The limiter lets at most `limit` calls run at once.  The limit grows by one call per round of
+calls that finish within the latency target, and shrinks by BACKOFF when a call is slower than the
+target or fails (AIMD), so a slowing engine gets fewer concurrent calls instead of a growing queue.
+Calls that cannot get a slot within the wait timeout fail fast.  Only calls that fail to connect, time
+out or get a 5xx or 429 (overloaded) response count as failed; calls rejected for their own sake (other
+4xx responses) and calls cut short by the deadline of their request count as neither slow nor failed.
+
+The breaker opens after a number of failed calls in a row, not counting 429 responses.  While it is open calls fail fast,
+without calling the engine; after the open time a single trial call is let through, which
+closes the breaker when it succeeds and opens it again when it fails.
+"""
+import os
+import threading
+import time
+
+import requests
+from text_analytics import nlp_deadline
+
+# Latency target of engine calls; 0 uses LATENCY_TOLERANCE times the usual (lowest recent) latency,
+# but at least MIN_LATENCY_TARGET
+default_latency_target_ms = float(os.getenv("NLP_LATENCY_TARGET_MS", "0"))
+# Seconds a call waits for a free slot under the concurrency limit before it fails fast
+default_limit_wait_seconds = float(os.getenv("NLP_LIMIT_WAIT_SECONDS", "10"))
+# Failed engine calls in a row that open the breaker
+default_breaker_failures = int(os.getenv("NLP_BREAKER_FAILURES", "5"))
+# Seconds the breaker stays open before it lets a trial call through
+default_breaker_open_seconds = float(os.getenv("NLP_BREAKER_OPEN_SECONDS", "30"))
+
+# Factor the limit is multiplied by when a call is slow or fails
+BACKOFF = 0.7
+# Calls slower than this many times the usual latency count as slow, when there is no latency target
+LATENCY_TOLERANCE = 2.0
+# Calls faster than this many seconds never count as slow, whatever the usual latency
+MIN_LATENCY_TARGET = 0.1
+# Share of the distance to a higher latency the usual latency moves by per call, so it follows an
+# engine that got slower for good
+BASELINE_DRIFT = 0.01
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+class BackendUnavailable(Exception):
+    """Raised instead of calling an NLP engine whose breaker is open or that has no free slot in time"""
+    pass
+
+
+class ConcurrencyLimiter:
+    def __init__(self, max_limit, latency_target=None, wait_seconds=default_limit_wait_seconds):
+        self.max_limit = max(int(max_limit), 1)
+        self.latency_target = latency_target  # seconds, or None to derive it from the usual latency
+        self.wait_seconds = wait_seconds
+        self.limit = float(self.max_limit)
+        self.in_flight = 0
+        self.usual_latency = None
+        self._last_backoff = 0.0  # calls started before the last backoff do not back off again
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        """Waits for a free slot and returns the start time of the call, to pass to release()"""
+        wait_seconds = nlp_deadline.timeout(self.wait_seconds)
+        with self._condition:
+            if not self._condition.wait_for(lambda: self.in_flight < int(self.limit), wait_seconds):
+                nlp_deadline.check()
+                raise BackendUnavailable("no free slot under the concurrency limit of %d" % int(self.limit))
+            self.in_flight += 1
+        return time.monotonic()
+
+    def release(self, started, succeeded):
+        """Ends a call; succeeded is None when the outcome says nothing about the engine"""
+        now = time.monotonic()
+        latency = now - started
+        with self._condition:
+            self.in_flight -= 1
+            if succeeded is None:
+                pass
+            elif succeeded and latency <= self._target(latency):
+                self.limit = min(self.limit + 1.0 / self.limit, self.max_limit)
+            elif started >= self._last_backoff:
+                self.limit = max(self.limit * BACKOFF, 1.0)
+                self._last_backoff = now
+            self._condition.notify_all()
+
+    def _target(self, latency):
+        if self.latency_target:
+            return self.latency_target
+        if self.usual_latency is None or latency < self.usual_latency:
+            self.usual_latency = latency
+        else:
+            self.usual_latency += (latency - self.usual_latency) * BASELINE_DRIFT
+        return max(self.usual_latency * LATENCY_TOLERANCE, MIN_LATENCY_TARGET)
+
+    def stats(self):
+        with self._condition:
+            return {"limit": int(self.limit), "maxLimit": self.max_limit, "inFlight": self.in_flight,
+                    "latencyTargetMs": round(self.latency_target * 1000, 1) if self.latency_target else None,
+                    "usualLatencyMs": round(self.usual_latency * 1000, 1) if self.usual_latency is not None else None}
+
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold=default_breaker_failures, open_seconds=default_breaker_open_seconds):
+        self.failure_threshold = max(int(failure_threshold), 1)
+        self.open_seconds = open_seconds
+        self.state = CLOSED
+        self.failures = 0  # in a row
+        self.opened_at = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """
+        Returns the state a call may be made in now (CLOSED, or HALF_OPEN for the trial call), to pass to
+        record(), or None when the call must fail fast
+        """
+        with self._lock:
+            if self.state == OPEN and time.monotonic() - self.opened_at >= self.open_seconds:
+                self.state = HALF_OPEN
+            if self.state == CLOSED:
+                return CLOSED
+            if self.state == HALF_OPEN and not self._trial_running:
+                self._trial_running = True
+                return HALF_OPEN
+            return None
+
+    def record(self, allowed_state, succeeded):
+        """Records the outcome of an allowed call, or None when it was not made after all"""
+        with self._lock:
+            if allowed_state == HALF_OPEN:
+                self._trial_running = False
+            if succeeded is None:
+                return
+            if succeeded:
+                self.failures = 0
+                self.state = CLOSED
+                return
+            self.failures += 1
+            if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = OPEN
+                self.opened_at = time.monotonic()
+
+    def stats(self):
+        with self._lock:
+            stats = {"state": self.state, "failures": self.failures, "failureThreshold": self.failure_threshold}
+            if self.state != CLOSED:
+                stats["openSeconds"] = round(time.monotonic() - self.opened_at, 1)
+            return stats
+
+
+class BackendGuard:
+    """The concurrency limiter and circuit breaker of one NLP config"""
+
+    def __init__(self, max_limit, latency_target=None, wait_seconds=default_limit_wait_seconds,
+                 failure_threshold=default_breaker_failures, open_seconds=default_breaker_open_seconds):
+        self.limiter = ConcurrencyLimiter(max_limit, latency_target, wait_seconds)
+        self.breaker = CircuitBreaker(failure_threshold, open_seconds)
+
+    def call(self, func, *args):
+        """Returns func(*args), or raises BackendUnavailable without calling it while the engine is unhealthy"""
+        allowed_state = self.breaker.allow()
+        if allowed_state is None:
+            raise BackendUnavailable("circuit breaker is open")
+        try:
+            started = self.limiter.acquire()
+        except Exception:  # no slot in time, or the request deadline passed
+            self.breaker.record(allowed_state, None)
+            raise
+        limiter_outcome = breaker_outcome = False
+        try:
+            result = func(*args)
+            limiter_outcome = breaker_outcome = True
+            return result
+        except nlp_deadline.DeadlineExceeded:  # e.g. no time left for a retry
+            limiter_outcome = breaker_outcome = None
+            raise
+        except Exception as ex:
+            if nlp_deadline.exceeded():  # cut short by the deadline of the request, not the engine's fault
+                limiter_outcome = breaker_outcome = None
+                raise nlp_deadline.DeadlineExceeded("request deadline exceeded calling the NLP engine") from ex
+            limiter_outcome, breaker_outcome = failure_outcomes(ex)
+            raise
+        finally:
+            self.limiter.release(started, limiter_outcome)
+            self.breaker.record(allowed_state, breaker_outcome)
+
+    def stats(self):
+        return {"limiter": self.limiter.stats(), "breaker": self.breaker.stats()}
+
+
+def failure_outcomes(ex):
+    """
+    Returns what a failed engine call says about the engine, as the outcomes for the limiter and the breaker:
+    False for a failed engine (no connection, timeout, 5xx), False for the limiter only for an overloaded one
+    (429), and None when the call itself was at fault (other 4xx, errors handling the response)
+    """
+    if isinstance(ex, (requests.ConnectionError, requests.Timeout, ConnectionError, TimeoutError)):
+        return False, False
+    status = _status_code(ex)
+    if status == 429:
+        return False, None
+    if status is not None and status >= 500:
+        return False, False
+    return None, None
+
+
+def _status_code(ex):
+    """The http status of requests' HTTPError and of the ACD SDK's ApiException, or None"""
+    response = getattr(ex, 'response', None)
+    if response is not None:
+        return response.status_code
+    status = getattr(ex, 'status_code', getattr(ex, 'code', None))  # ApiException.code before SDK core 3.10
+    return status if isinstance(status, int) else None
@@ -0,0 +1,217 @@
+"""
+Asynchronous enhancement jobs.
+
+A job is queued in memory and run by a small pool of job threads.  Its status and result are
+saved as files in a directory shared by the worker processes, so any worker can answer for a job,
+and are removed once they have not changed for the time to live.  The queue is bounded: a job
+that finds it full is rejected instead of waiting.
+
+Every worker process sweeps the directory on a timer: it renews the status of its unfinished jobs,
+fails the unfinished jobs that nobody renewed (lost when their worker process stopped) and removes
+the expired ones.  Replicas answer for each other's jobs only when they share the directory.
+"""
+import datetime
+import json
+import logging
+import os
+import queue
+import re
+import threading
+import time
+import uuid
+
+from text_analytics import nlp_metrics
+from text_analytics.utils import fast_json
+
+logger = logging.getLogger()
+
+# Number of jobs run at the same time by each worker process
+job_workers = int(os.getenv("NLP_JOB_WORKERS", "2"))
+# Number of jobs that may wait to be run in each worker process
+job_queue_size = int(os.getenv("NLP_JOB_QUEUE_SIZE", "16"))
+# Seconds the status and result of a job are kept after its last change
+job_ttl_seconds = float(os.getenv("NLP_JOB_TTL_SECONDS", "3600"))
+
+QUEUED = "queued"
+WORKING = "working"
+DONE = "done"
+ERROR = "error"
+
+# Seconds between the sweeps of the job directory
+SWEEP_SECONDS = 30
+# An unfinished job whose status was not renewed for this long was lost with its worker process
+LOST_SECONDS = 4 * SWEEP_SECONDS
+
+JOB_ID = re.compile('[0-9a-f]{32}')
+
+
+class QueueFull(Exception):
+    pass
+
+
+class JobStore:
+    """Status (<id>.json) and result (<id>.result) files of the jobs, in a directory"""
+
+    def __init__(self, directory, ttl=job_ttl_seconds):
+        self.directory = directory
+        self.ttl = ttl
+        os.makedirs(directory, exist_ok=True)
+
+    def save_status(self, status):
+        self._write(status["id"] + ".json", json.dumps(status).encode('utf-8'))
+
+    def read_status(self, job_id):
+        """Returns the status of the job, or None for unknown and expired jobs"""
+        if not JOB_ID.fullmatch(job_id):
+            return None
+        try:
+            with open(self._path(job_id + ".json"), 'rb') as status_file:
+                if self._expired(os.fstat(status_file.fileno()).st_mtime):
+                    return None
+                return json.loads(status_file.read())
+        except FileNotFoundError:
+            return None
+
+    def save_result(self, job_id, body):
+        self._write(job_id + ".result", body)
+
+    def read_result(self, job_id):
+        with open(self._path(job_id + ".result"), 'rb') as result_file:
+            return result_file.read()
+
+    def expire(self):
+        """Removes the files of the jobs whose status did not change within the time to live"""
+        for file_name in os.listdir(self.directory):
+            job_id, extension = os.path.splitext(file_name)
+            if extension != ".json":
+                continue
+            try:
+                if self._expired(os.stat(self._path(file_name)).st_mtime):
+                    self.remove(job_id)
+            except FileNotFoundError:  # removed by another process
+                pass
+
+    def renew(self, job_ids):
+        """Marks the status of the jobs as changed now"""
+        for job_id in job_ids:
+            try:
+                os.utime(self._path(job_id + ".json"))
+            except FileNotFoundError:
+                pass
+
+    def fail_lost(self):
+        """Fails the queued and working jobs whose status was not renewed within LOST_SECONDS"""
+        for file_name in os.listdir(self.directory):
+            job_id, extension = os.path.splitext(file_name)
+            if extension != ".json":
+                continue
+            try:
+                with open(self._path(file_name), 'rb') as status_file:
+                    if os.fstat(status_file.fileno()).st_mtime + LOST_SECONDS >= time.time():
+                        continue
+                    status = json.loads(status_file.read())
+            except FileNotFoundError:
+                continue
+            if status["status"] in (QUEUED, WORKING):
+                logger.warning("Job %s was lost when its worker process stopped", job_id)
+                self.save_status(dict(status, status=ERROR, finished=_now(),
+                                      error="The job was lost when its worker process stopped, submit it again"))
+                nlp_metrics.jobs.inc(event="lost")
+
+    def remove(self, job_id):
+        for file_name in (job_id + ".json", job_id + ".result"):
+            try:
+                os.remove(self._path(file_name))
+            except FileNotFoundError:
+                pass
+
+    def _expired(self, mtime):
+        return mtime + self.ttl < time.time()
+
+    def _write(self, file_name, content):
+        temp_file = self._path(".%s.%d.%d.tmp" % (file_name, os.getpid(), threading.get_ident()))
+        with open(temp_file, 'wb') as out_file:
+            out_file.write(content)
+        os.replace(temp_file, self._path(file_name))
+
+    def _path(self, file_name):
+        return os.path.join(self.directory, file_name)
+
+
+class JobRunner:
+    """
+    Runs the jobs of this worker process on job threads, started with the first job.
+    The sweeper thread is started with the runner.
+    """
+
+    def __init__(self, store, workers=job_workers, queue_size=job_queue_size):
+        self.store = store
+        self.workers = max(workers, 1)
+        self._queue = queue.Queue(maxsize=max(queue_size, 1))
+        self._threads = []
+        self._unfinished = set()  # ids of the jobs of this process
+        self._lock = threading.Lock()
+        threading.Thread(target=self._sweep, name="nlp-job-sweeper", daemon=True).start()
+
+    def submit(self, work):
+        """
+        Queues work (a function returning the json object of the result) and returns the status of its job.
+        Raises QueueFull when too many jobs are waiting.
+        """
+        self._start()
+        status = {"id": uuid.uuid4().hex, "status": QUEUED, "submitted": _now()}
+        with self._lock:
+            self._unfinished.add(status["id"])
+        self.store.save_status(status)
+        try:
+            self._queue.put_nowait((status, work))
+        except queue.Full:
+            self._finished(status["id"])
+            self.store.remove(status["id"])
+            nlp_metrics.jobs.inc(event="rejected")
+            raise QueueFull()
+        nlp_metrics.jobs.inc(event="submitted")
+        return status
+
+    def _start(self):
+        with self._lock:
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._run, name="nlp-job-%d" % len(self._threads), daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _run(self):
+        while True:
+            status, work = self._queue.get()
+            status = dict(status, status=WORKING, started=_now())
+            self.store.save_status(status)
+            try:
+                self.store.save_result(status["id"], fast_json.dumps_bytes(work()))
+                status = dict(status, status=DONE, finished=_now())
+                nlp_metrics.jobs.inc(event="done")
+            except Exception as ex:
+                logger.exception("Error in job %s", status["id"])
+                status = dict(status, status=ERROR, finished=_now(), error=str(ex))
+                nlp_metrics.jobs.inc(event="failed")
+            self.store.save_status(status)
+            self._finished(status["id"])
+
+    def _finished(self, job_id):
+        with self._lock:
+            self._unfinished.discard(job_id)
+
+    def _sweep(self):
+        while True:
+            try:
+                with self._lock:
+                    unfinished = list(self._unfinished)
+                self.store.renew(unfinished)
+                self.store.fail_lost()
+                self.store.expire()
+            except Exception:
+                logger.exception("Error when sweeping the job directory %s", self.store.directory)
+            time.sleep(max(min(SWEEP_SECONDS, self.store.ttl), 1))
+
+
+def _now():
+    return datetime.datetime.utcnow().isoformat(timespec='seconds') + 'Z'
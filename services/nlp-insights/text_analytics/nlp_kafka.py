@@ -0,0 +1,142 @@
+"""
+Kafka worker mode: enhances the bundles of an input topic and produces them to an output topic.
+
+Messages are consumed in batches and the resources of a batch are enhanced together, like the
+records of an ndjson request.  Every message is produced to the output topic with its key and
+headers, in order: enhanced when its AddNLPInsights header (set by expose-kafka) is "true", else
+as it was.  A message that cannot be enhanced is produced as it was, with an NLPInsightsError
+header.  Offsets are committed only once every message of the batch was produced; when producing
+fails the batch is consumed again, so each message is produced at least once.
+
+Every worker process runs a consumer in the same consumer group, so Kafka balances the partitions of the
+input topic over the worker processes of all replicas; processes beyond the number of partitions stay idle.
+kafka-python is only imported in this mode.
+"""
+import logging
+import os
+import time
+
+from text_analytics import nlp_metrics
+from text_analytics.utils import fast_json
+
+logger = logging.getLogger()
+
+# Consume bundles from Kafka, in addition to serving http requests
+kafka_enabled = os.getenv("NLP_KAFKA_ENABLED", "false") == 'true'
+# Connection to the brokers, as for expose-kafka
+kafka_bootstrap = os.getenv("KAFKABOOTSTRAP")
+kafka_user = os.getenv("KAFKAUSER")
+kafka_password = os.getenv("KAFKAPW")
+input_topic = os.getenv("NLP_KAFKA_INPUT_TOPIC", "")
+output_topic = os.getenv("NLP_KAFKA_OUTPUT_TOPIC", "")
+# Consumer group shared by all the worker processes and replicas
+group_id = os.getenv("NLP_KAFKA_GROUP", "nlp-insights")
+# Most messages enhanced together
+batch_size = int(os.getenv("NLP_KAFKA_BATCH_SIZE", "32"))
+
+ADD_NLP_INSIGHTS_HEADER = "AddNLPInsights"
+ERROR_HEADER = "NLPInsightsError"
+# Largest message produced, as for expose-kafka
+MAX_REQUEST_SIZE = 10000000
+POLL_TIMEOUT_MS = 1000
+PRODUCE_TIMEOUT_SECONDS = 60
+# Wait before connecting again, or consuming a batch again after it could not be produced
+RETRY_SECONDS = 5
+
+
+def create_clients():
+    """Returns a kafka-python consumer of the input topic and a producer, once the brokers can be reached"""
+    from kafka import KafkaConsumer, KafkaProducer
+    sasl = {"sasl_mechanism": "PLAIN", "sasl_plain_username": kafka_user, "sasl_plain_password": kafka_password}
+    while True:
+        try:
+            consumer = KafkaConsumer(input_topic, bootstrap_servers=kafka_bootstrap, group_id=group_id,
+                                     enable_auto_commit=False, auto_offset_reset='earliest',
+                                     max_poll_records=batch_size, **sasl)
+            producer = KafkaProducer(bootstrap_servers=kafka_bootstrap, max_request_size=MAX_REQUEST_SIZE,
+                                     acks='all', **sasl)
+            return consumer, producer
+        except Exception:
+            logger.exception("Error connecting to Kafka at %s, retrying", kafka_bootstrap)
+            time.sleep(RETRY_SECONDS)
+
+
+class KafkaWorker:
+    """
+    Consumes, enhances and produces batches of messages until stopped.
+
+    enhance - function enhancing a list of records (json objects) and returning them in order
+    is_ready - function returning whether messages can be enhanced yet (configs loaded)
+    """
+
+    def __init__(self, consumer, producer, output_topic, enhance, is_ready=lambda: True, batch_size=batch_size):
+        self.consumer = consumer
+        self.producer = producer
+        self.output_topic = output_topic
+        self.enhance = enhance
+        self.is_ready = is_ready
+        self.batch_size = batch_size
+
+    def run(self, stop):
+        """Runs until the stop event is set"""
+        while not stop.is_set():
+            if not self.is_ready():
+                stop.wait(1)
+                continue
+            batches = self.consumer.poll(timeout_ms=POLL_TIMEOUT_MS, max_records=self.batch_size)
+            messages = [message for partition_messages in batches.values() for message in partition_messages]
+            if not messages:
+                continue
+            try:
+                self.produce(messages, self.enhance_messages(messages))
+                self.consumer.commit()
+            except Exception:
+                logger.exception("Error producing a batch of %d messages, consuming it again", len(messages))
+                for partition, partition_messages in batches.items():
+                    self.consumer.seek(partition, partition_messages[0].offset)
+                stop.wait(RETRY_SECONDS)
+
+    def enhance_messages(self, messages):
+        """Returns the (value, headers) to produce for each message"""
+        outputs = [(message.value, list(message.headers or [])) for message in messages]
+        to_enhance = []  # indexes of the messages to enhance
+        for index, message in enumerate(messages):
+            if _header(message, ADD_NLP_INSIGHTS_HEADER) == 'true':
+                to_enhance.append(index)
+            else:
+                nlp_metrics.kafka_messages.inc(outcome="passed")
+        if not to_enhance:
+            return outputs
+
+        try:
+            records = self.enhance([fast_json.loads(messages[index].value) for index in to_enhance])
+        except Exception:
+            logger.exception("Error when enhancing Kafka batch, retrying its messages one at a time")
+            records = None
+        for position, index in enumerate(to_enhance):
+            message = messages[index]
+            try:
+                # records are enhanced in place, so a failed batch is parsed again from the messages
+                record = records[position] if records is not None else self.enhance([fast_json.loads(message.value)])[0]
+                outputs[index] = (fast_json.dumps_bytes(record), outputs[index][1])
+                nlp_metrics.kafka_messages.inc(outcome="enhanced")
+            except Exception as ex:
+                logger.exception("Error when enhancing Kafka message at offset %s", message.offset)
+                outputs[index] = (message.value, outputs[index][1] + [(ERROR_HEADER, str(ex).encode('utf-8'))])
+                nlp_metrics.kafka_messages.inc(outcome="failed")
+        return outputs
+
+    def produce(self, messages, outputs):
+        """Produces the outputs to the output topic and waits until all of them are written"""
+        futures = [self.producer.send(self.output_topic, key=message.key, value=value, headers=headers)
+                   for message, (value, headers) in zip(messages, outputs)]
+        self.producer.flush()
+        for future in futures:
+            future.get(timeout=PRODUCE_TIMEOUT_SECONDS)
+
+
+def _header(message, name):
+    for key, value in message.headers or []:
+        if key == name:
+            return value.decode('utf-8') if isinstance(value, bytes) else value
+    return None
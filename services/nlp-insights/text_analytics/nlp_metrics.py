@@ -0,0 +1,177 @@
+import contextlib
+import threading
+import time
+
+# Bucket upper bounds for stage latencies, in seconds
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# Bucket upper bounds for request sizes, in bytes (1KB to 64MB)
+SIZE_BUCKETS = tuple(1024 * 4 ** i for i in range(9))
+
+
+class Counter:
+    """Monotonically increasing count, per combination of label values"""
+
+    type_name = "counter"
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._values = {}  # label values -> count
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = _label_values(self.label_names, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        return [(self.name + "_total", _label_pairs(self.label_names, key), value) for key, value in values]
+
+
+class Histogram:
+    """Counts of observed values per bucket, with their sum, per combination of label values"""
+
+    type_name = "histogram"
+
+    def __init__(self, name, documentation, label_names=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}  # label values -> [count per bucket..., count of larger values, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = _label_values(self.label_names, labels)
+        index = next((i for i, bound in enumerate(self.buckets) if value <= bound), len(self.buckets))
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """Observes the number of seconds the with block takes, also when it raises"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        with self._lock:
+            values = sorted((key, list(counts)) for key, counts in self._values.items())
+        samples = []
+        for key, counts in values:
+            pairs = _label_pairs(self.label_names, key)
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                samples.append((self.name + "_bucket", pairs + [("le", _format_value(bound))], cumulative))
+            samples.append((self.name + "_count", pairs, cumulative))
+            samples.append((self.name + "_sum", pairs, counts[-1]))
+        return samples
+
+
+class MetricsRegistry:
+    """The metrics of the service, rendered in the Prometheus text exposition format"""
+
+    def __init__(self):
+        self._metrics = []
+
+    def counter(self, name, documentation, label_names=()):
+        return self._register(Counter(name, documentation, label_names))
+
+    def histogram(self, name, documentation, label_names=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(name, documentation, label_names, buckets))
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.append("# HELP %s %s" % (metric.name, metric.documentation))
+            lines.append("# TYPE %s %s" % (metric.name, metric.type_name))
+            for sample_name, pairs, value in metric.samples():
+                labels = ",".join('%s="%s"' % (name, _escape(label_value)) for name, label_value in pairs)
+                lines.append("%s%s %s" % (sample_name, "{" + labels + "}" if labels else "", _format_value(value)))
+        return "\n".join(lines) + "\n"
+
+
+def _label_values(label_names, labels):
+    return tuple(str(labels.get(name, "")) for name in label_names)
+
+
+def _label_pairs(label_names, label_values):
+    return list(zip(label_names, label_values))
+
+
+def _escape(label_value):
+    return label_value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+registry = MetricsRegistry()
+
+request_size_bytes = registry.histogram(
+    "nlp_insights_request_size_bytes", "Size of each request body or ndjson record.",
+    buckets=SIZE_BUCKETS)
+json_parse_seconds = registry.histogram(
+    "nlp_insights_json_parse_seconds", "Time spent parsing request json.")
+enhance_seconds = registry.histogram(
+    "nlp_insights_enhance_seconds", "Time spent enhancing one resource, by resource type.",
+    ["resource_type"])
+nlp_call_seconds = registry.histogram(
+    "nlp_insights_nlp_call_seconds", "Time spent in calls to an NLP backend, by config name.",
+    ["config"])
+insight_build_seconds = registry.histogram(
+    "nlp_insights_insight_build_seconds", "Time spent building insights from NLP responses, by resource type.",
+    ["resource_type"])
+evidence_encode_seconds = registry.histogram(
+    "nlp_insights_evidence_encode_seconds", "Time spent encoding NLP responses as insight evidence.")
+response_serialize_seconds = registry.histogram(
+    "nlp_insights_response_serialize_seconds", "Time spent serializing response json.")
+resources_processed = registry.counter(
+    "nlp_insights_resources_processed", "Resources enhanced, by resource type.",
+    ["resource_type"])
+resources_unchanged = registry.counter(
+    "nlp_insights_resources_unchanged",
+    "Resources returned as is because this process version already enhanced the same texts with the same config, by resource type.",
+    ["resource_type"])
+resources_unfinished = registry.counter(
+    "nlp_insights_resources_unfinished", "Resources returned as is because the request deadline passed, by resource type.",
+    ["resource_type"])
+insights_created = registry.counter(
+    "nlp_insights_insights_created", "Insights added to resources.")
+text_chunks = registry.counter(
+    "nlp_insights_text_chunks", "Chunks that texts longer than the chunk size were split into, by config name.",
+    ["config"])
+backend_errors = registry.counter(
+    "nlp_insights_backend_errors", "Failed calls to an NLP backend, by config name.",
+    ["config"])
+backend_rejected = registry.counter(
+    "nlp_insights_backend_rejected",
+    "NLP backend calls failed fast because the breaker was open or no slot was free under the concurrency limit, by config name.",
+    ["config"])
+backend_fallbacks = registry.counter(
+    "nlp_insights_backend_fallbacks", "Texts analyzed by the fallback config of an unavailable NLP backend, by config name.",
+    ["config"])
+jobs = registry.counter(
+    "nlp_insights_jobs", "Async jobs submitted, rejected because the queue was full, done, failed and lost with their worker process, by event.",
+    ["event"])
+kafka_messages = registry.counter(
+    "nlp_insights_kafka_messages",
+    "Kafka messages enhanced, passed on as they were (no AddNLPInsights header) and failed in worker mode, by outcome.",
+    ["outcome"])
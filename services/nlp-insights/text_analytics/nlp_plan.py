@@ -0,0 +1,60 @@
+from text_analytics.enhance import texts_to_analyze
+
+
+class PlannedNLPService:
+    """
+    Wraps an NLP service so that process() returns responses that were analyzed ahead of time.
+
+    Used when enhancing the resources of a bundle: every text of the bundle is analyzed once up
+    front, and the enhancers then get their responses from here.  Texts that were not planned
+    are passed on to the wrapped service, with the config snapshot of the request to look up its
+    fallback config in.  All other attributes come from the wrapped service.
+
+    One is created per config for each request, and keeps the insight evidence encoded for its
+    responses until the request is done (see fhir_object_utils.encode_insight_detail).
+    """
+
+    def __init__(self, nlp_service, responses, config):
+        self._nlp_service = nlp_service
+        self._responses = responses
+        self._config = config
+        self.evidence_encodings = {}
+
+    def process(self, text):
+        response = self._responses.get(self._key(text))
+        if response is None:
+            return self._nlp_service.process(text, config=self._config)
+        return response
+
+    def process_many(self, texts):
+        keys = [self._key(text) for text in texts]
+        unplanned = [text for text, key in zip(texts, keys) if key not in self._responses]
+        analyzed = dict(zip(map(self._key, unplanned), self._nlp_service.process_many(unplanned, self._config)))
+        return [self._responses[key] if key in self._responses else analyzed[key] for key in keys]
+
+    @staticmethod
+    def _key(text):
+        return text.decode('utf-8') if isinstance(text, bytes) else text
+
+    def __getattr__(self, name):
+        return getattr(self._nlp_service, name)
+
+
+def plan_texts(config, resources):
+    """
+    Returns the unique texts that enhancing the resources will send to NLP, grouped by the
+    config that will analyze them, as a dict of config name to list of texts.
+    """
+    plan = {}
+    for resource in resources:
+        resource_type = resource['resourceType']
+        nlp_service = config.service_for(resource_type)
+        if nlp_service is None or resource_type not in nlp_service.types_can_handle:
+            continue
+        get_texts = texts_to_analyze.get(resource_type)
+        if get_texts is None:
+            continue
+        texts = plan.setdefault(nlp_service.config_name, {})  # dict keeps the texts unique and ordered
+        for text in get_texts(resource):
+            texts[text] = None
+    return {config_name: list(texts) for config_name, texts in plan.items()}
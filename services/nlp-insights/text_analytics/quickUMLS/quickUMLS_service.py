@@ -1,12 +1,13 @@
 import json
 import logging
-import requests
 import os
 
 from text_analytics.abstract_nlp_service import NLPService
 from text_analytics.enhance import *
+from text_analytics.quickUMLS.quickUMLS_session import QuickUMLSSession
 from text_analytics.quickUMLS.semtype_lookup import lookup
 from text_analytics.quickUMLS.semtype_lookup import get_semantic_type_list
+from text_analytics.utils import fast_json
 
 logger = logging.getLogger()
 
@@ -21,20 +22,35 @@ class QuickUMLSService(NLPService):
     PROCESS_TYPE_STRUCTURED = "QuickUMLS Structured"
 
     def __init__(self, json_string):
+        super().__init__(json_string)
         config_dict = json.loads(json_string)
         self.quickUMLS_url = config_dict["config"]["endpoint"]
-        self.jsonString = json_string
-        self.config_name = config_dict["name"]
+        session_settings = {"pool_size": self.pool_size}
+        for key, setting in [("connectTimeout", "connect_timeout"),
+                             ("readTimeout", "read_timeout"), ("retries", "retries"), ("retryBackoff", "backoff")]:
+            if config_dict["config"].get(key) is not None:
+                session_settings[setting] = config_dict["config"][key]
+        self.session = QuickUMLSSession(**session_settings)
 
+    def warm_up(self):
+        self.session.warm_up(self.quickUMLS_url)
 
-    def process(self, text):
+    def close(self):
+        super().close()
+        self.session.close()
+
+    def stats(self):
+        return self.session.stats()
+
+
+    def analyze(self, text):
         if type(text) is bytes:
             request_body = {"text": text.decode('utf-8')}
         else:
             request_body = {"text": text}
         logger.info("Calling QUICKUMLS-" + self.config_name)
-        resp = requests.post(self.quickUMLS_url, json=request_body)
-        concepts = json.loads(resp.text)
+        resp = self.session.post(self.quickUMLS_url, request_body)
+        concepts = fast_json.loads(resp.content)
         conceptsList = []
         if concepts is not None:
             for concept in concepts:
@@ -0,0 +1,93 @@
+import logging
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from text_analytics import nlp_deadline
+
+logger = logging.getLogger()
+
+# Responses that mean the QuickUMLS server was (temporarily) unable to answer
+RETRY_STATUS_CODES = {429, 502, 503, 504}
+
+
+class QuickUMLSSession:
+    """
+    Keep-alive HTTP session for one QuickUMLS config.
+
+    At most pool_size connections are opened to the server; callers wait for a free connection
+    instead of opening more.  Every call has a connect and a read timeout, and calls that fail
+    to connect, time out or get a retryable status are retried with exponential backoff and full
+    jitter.  Matching text has no side effects, so retrying the POST is safe.
+    The timeouts are shortened to the time left before the deadline of the request, and there is
+    no retry that the deadline would not leave time for.
+    """
+
+    def __init__(self, pool_size=8, connect_timeout=5.0, read_timeout=60.0, retries=2, backoff=0.5):
+        self.pool_size = max(pool_size, 1)
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, pool_block=True)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.in_flight = 0
+        self.retried = 0
+        self.failures = 0
+
+    def post(self, url, json_body):
+        """Posts the json body and returns the successful response, retrying failed attempts"""
+        self._count(calls=1, in_flight=1)
+        try:
+            attempt = 0
+            while True:
+                try:
+                    timeout = (nlp_deadline.timeout(self.timeout[0]), nlp_deadline.timeout(self.timeout[1]))
+                    resp = self.session.post(url, json=json_body, timeout=timeout)
+                    if resp.status_code not in RETRY_STATUS_CODES or attempt >= self.retries:
+                        resp.raise_for_status()
+                        return resp
+                    logger.warning("QuickUMLS returned %s, retrying", resp.status_code)
+                except (requests.ConnectionError, requests.Timeout) as ex:
+                    if attempt >= self.retries:
+                        raise
+                    logger.warning("QuickUMLS call failed (%s), retrying", ex)
+                attempt += 1
+                delay = random.uniform(0, self.backoff * 2 ** (attempt - 1))
+                nlp_deadline.check(delay)
+                self._count(retried=1)
+                time.sleep(delay)
+        except Exception:
+            self._count(failures=1)
+            raise
+        finally:
+            self._count(in_flight=-1)
+
+    def warm_up(self, url):
+        """Opens a keep-alive connection to the server by matching an empty text, without retries"""
+        self.session.post(url, json={"text": ""}, timeout=self.timeout).raise_for_status()
+
+    def close(self):
+        self.session.close()
+
+    def stats(self):
+        with self._lock:
+            return {"poolSize": self.pool_size,
+                    "connectTimeout": self.timeout[0],
+                    "readTimeout": self.timeout[1],
+                    "requests": self.calls,
+                    "inFlight": self.in_flight,
+                    "retries": self.retried,
+                    "failures": self.failures}
+
+    def _count(self, calls=0, in_flight=0, retried=0, failures=0):
+        with self._lock:
+            self.calls += calls
+            self.in_flight += in_flight
+            self.retried += retried
+            self.failures += failures
@@ -0,0 +1,86 @@
+"""
+In-process stand-in for a Kafka broker, to run nlp_kafka.KafkaWorker in tests without Kafka.
+"""
+import collections
+import threading
+
+from concurrent.futures import Future
+
+MemoryRecord = collections.namedtuple('MemoryRecord', ['topic', 'partition', 'offset', 'key', 'value', 'headers'])
+MemoryTopicPartition = collections.namedtuple('MemoryTopicPartition', ['topic', 'partition'])
+
+
+class MemoryBroker:
+    """
+    Topics with one partition each.  consumer() and producer() return clients with the methods of the
+    kafka-python clients that KafkaWorker uses.
+    """
+
+    def __init__(self):
+        self.topics = collections.defaultdict(list)  # topic -> records
+        self.committed = {}  # (group id, topic) -> offset of the next record
+        self._condition = threading.Condition()
+
+    def produce(self, topic, value, key=None, headers=None):
+        with self._condition:
+            records = self.topics[topic]
+            records.append(MemoryRecord(topic, 0, len(records), key, value, list(headers or [])))
+            self._condition.notify_all()
+
+    def messages(self, topic):
+        with self._condition:
+            return list(self.topics[topic])
+
+    def consumer(self, topic, group_id="nlp-insights"):
+        return MemoryConsumer(self, topic, group_id)
+
+    def producer(self):
+        return MemoryProducer(self)
+
+
+class MemoryConsumer:
+    def __init__(self, broker, topic, group_id):
+        self.broker = broker
+        self.topic = topic
+        self.group_id = group_id
+        self.partition = MemoryTopicPartition(topic, 0)
+        with broker._condition:
+            self.position = broker.committed.get((group_id, topic), 0)
+
+    def poll(self, timeout_ms=0, max_records=None):
+        broker = self.broker
+        with broker._condition:
+            broker._condition.wait_for(lambda: len(broker.topics[self.topic]) > self.position, timeout_ms / 1000)
+            records = broker.topics[self.topic][self.position:]
+            if max_records is not None:
+                records = records[:max_records]
+            self.position += len(records)
+        return {self.partition: records} if records else {}
+
+    def seek(self, partition, offset):
+        self.position = offset
+
+    def commit(self):
+        with self.broker._condition:
+            self.broker.committed[(self.group_id, self.topic)] = self.position
+
+
+class MemoryProducer:
+    def __init__(self, broker):
+        self.broker = broker
+
+    def send(self, topic, value=None, key=None, headers=None):
+        self.broker.produce(topic, value, key, headers)
+        future = MemoryFuture()
+        future.set_result(None)
+        return future
+
+    def flush(self):
+        pass
+
+
+class MemoryFuture(Future):
+    """Future with the get() of kafka-python's send futures"""
+
+    def get(self, timeout=None):
+        return self.result(timeout)
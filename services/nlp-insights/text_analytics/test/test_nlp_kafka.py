@@ -0,0 +1,84 @@
+import json
+import threading
+
+from memory_broker import MemoryBroker, MemoryFuture, MemoryProducer
+from text_analytics import nlp_kafka
+
+BUNDLE = json.dumps({"resourceType": "Bundle", "type": "transaction", "entry": []}).encode('utf-8')
+
+
+def enhance(records):
+    return [dict(record, enhanced=True) for record in records]
+
+
+class FailingProducer(MemoryProducer):
+    """Fails the first send of the message with the given key"""
+
+    def __init__(self, broker, failing_key):
+        super().__init__(broker)
+        self.failing_key = failing_key
+
+    def send(self, topic, value=None, key=None, headers=None):
+        if key == self.failing_key:
+            self.failing_key = None
+            future = MemoryFuture()
+            future.set_exception(RuntimeError("broker unavailable"))
+            return future
+        return super().send(topic, value, key, headers)
+
+
+def run_until_committed(worker, broker, offset):
+    """Runs the worker until the input topic is committed up to offset, and returns the commits made"""
+    commits = []  # (committed offset, messages in the output topic at the time)
+    consumer_commit = worker.consumer.commit
+
+    def commit():
+        consumer_commit()
+        commits.append((worker.consumer.position, len(broker.messages("out"))))
+        if worker.consumer.position >= offset:
+            stop.set()
+
+    worker.consumer.commit = commit
+    stop = threading.Event()
+    thread = threading.Thread(target=worker.run, args=(stop,))
+    thread.start()
+    thread.join(10)
+    stop.set()  # in case it timed out
+    thread.join()
+    return commits
+
+
+def test_enhances_passes_through_and_flags_messages():
+    broker = MemoryBroker()
+    broker.produce("in", BUNDLE, key=b"1", headers=[("AddNLPInsights", b"true")])
+    broker.produce("in", BUNDLE, key=b"2", headers=[("AddNLPInsights", b"false")])
+    broker.produce("in", b"{not json", key=b"3", headers=[("AddNLPInsights", b"true")])
+    broker.produce("in", BUNDLE, key=b"4")
+    worker = nlp_kafka.KafkaWorker(broker.consumer("in"), broker.producer(), "out", enhance, batch_size=10)
+
+    run_until_committed(worker, broker, 4)
+
+    out = broker.messages("out")
+    assert [message.key for message in out] == [b"1", b"2", b"3", b"4"]
+    assert json.loads(out[0].value)["enhanced"] is True
+    assert out[1].value == BUNDLE  # AddNLPInsights is false
+    assert out[3].value == BUNDLE  # no AddNLPInsights header
+    assert out[2].value == b"{not json"
+    assert [name for name, value in out[2].headers] == ["AddNLPInsights", nlp_kafka.ERROR_HEADER]
+    assert broker.committed[("nlp-insights", "in")] == 4
+
+
+def test_commits_only_after_every_message_is_produced(monkeypatch):
+    monkeypatch.setattr(nlp_kafka, "RETRY_SECONDS", 0.01)
+    broker = MemoryBroker()
+    for key in (b"1", b"2", b"3"):
+        broker.produce("in", BUNDLE, key=key, headers=[("AddNLPInsights", b"true")])
+    worker = nlp_kafka.KafkaWorker(broker.consumer("in"), FailingProducer(broker, b"3"), "out", enhance,
+                                   batch_size=10)
+
+    commits = run_until_committed(worker, broker, 3)
+
+    # the first attempt produced 1 and 2 but failed on 3, so nothing was committed and the batch was consumed again
+    assert commits == [(3, 5)]
+    assert [message.key for message in broker.messages("out")] == [b"1", b"2", b"1", b"2", b"3"]
+    assert broker.committed[("nlp-insights", "in")] == 3
@@ -0,0 +1,156 @@
+"""
+gzip and deflate Content-Encoding of request bodies, and Accept-Encoding negotiated compression of responses.
+"""
+import os
+import zlib
+
+# zlib window bits of each encoding; "deflate" is the zlib format (RFC 9110), some clients send raw deflate
+WBITS = {'gzip': 16 + zlib.MAX_WBITS, 'deflate': zlib.MAX_WBITS}
+# Compression level of responses (1 is fastest, 9 smallest)
+compression_level = int(os.getenv("NLP_COMPRESSION_LEVEL", "6"))
+# Responses smaller than this many bytes are not worth compressing
+compression_min_bytes = int(os.getenv("NLP_COMPRESSION_MIN_BYTES", "1024"))
+# Most bytes a compressed request body (or each line of a compressed ndjson body) may decompress to
+max_decompressed_bytes = int(os.getenv("NLP_MAX_DECOMPRESSED_BYTES", str(100 * 1024 * 1024)))
+
+
+class UnsupportedEncoding(ValueError):
+    pass
+
+
+class TooLarge(ValueError):
+    """Raised when a compressed request body decompresses to more than max_decompressed_bytes"""
+    pass
+
+
+def _decompressor(content_encoding):
+    encoding = (content_encoding or 'identity').strip().lower()
+    if encoding == 'identity':
+        return None
+    if encoding == 'x-gzip':
+        encoding = 'gzip'
+    if encoding not in WBITS:
+        raise UnsupportedEncoding(content_encoding)
+    return _Decompressor(encoding)
+
+
+class _Decompressor:
+    def __init__(self, encoding):
+        self.encoding = encoding
+        self._zlib = None
+
+    def decompress(self, data, max_length=0):
+        """Decompresses data, returning at most max_length bytes (0: all); the rest is returned by more()"""
+        if self._zlib is None:
+            if not data:
+                return b''
+            wbits = WBITS[self.encoding]
+            if self.encoding == 'deflate' and (data[0] & 0x0f) != zlib.DEFLATED:
+                wbits = -zlib.MAX_WBITS  # raw deflate, without the zlib header
+            self._zlib = zlib.decompressobj(wbits)
+        return self._zlib.decompress(data, max_length)
+
+    def more(self, max_length):
+        """Returns the next bytes of the data given to decompress() that max_length held back, or b''"""
+        if self._zlib is None or not self._zlib.unconsumed_tail:
+            return b''
+        return self._zlib.decompress(self._zlib.unconsumed_tail, max_length)
+
+    def flush(self):
+        """Returns the last bytes of the body, raising zlib.error when the body is cut short"""
+        if self._zlib is None:
+            return b''
+        data = self._zlib.flush()
+        if not self._zlib.eof:
+            raise zlib.error("compressed data is truncated")
+        return data
+
+
+def decompress(data, content_encoding, max_bytes=None):
+    """
+    Returns the request body decoded from its Content-Encoding (gzip, deflate or identity).
+    Raises TooLarge when it decodes to more than max_bytes (default max_decompressed_bytes), and
+    zlib.error when it is corrupt or truncated.
+    """
+    decompressor = _decompressor(content_encoding)
+    if decompressor is None:
+        return data
+    if max_bytes is None:
+        max_bytes = max_decompressed_bytes
+    body = decompressor.decompress(data, max_bytes + 1)
+    body += decompressor.flush() if len(body) <= max_bytes else b''
+    if len(body) > max_bytes:
+        raise TooLarge("request body decompresses to more than %d bytes" % max_bytes)
+    return body
+
+
+def decompressed_lines(stream, content_encoding, block_size=64 * 1024, max_line_bytes=None):
+    """
+    Returns an iterator over the lines of a request body stream, decoded from its Content-Encoding as it is read.
+    Lines are decompressed block_size bytes at a time; the iterator raises TooLarge on a line longer than
+    max_line_bytes (default max_decompressed_bytes), and zlib.error when the body is corrupt or truncated.
+    """
+    decompressor = _decompressor(content_encoding)
+    if decompressor is None:
+        return stream
+    if max_line_bytes is None:
+        max_line_bytes = max_decompressed_bytes
+    return _decompressed_lines(stream, decompressor, block_size, max_line_bytes)
+
+
+def _decompressed_lines(stream, decompressor, block_size, max_line_bytes):
+    pending = b''
+    while True:
+        block = stream.read(block_size)
+        data = decompressor.decompress(block, block_size) if block else decompressor.flush()
+        while data:
+            lines = (pending + data).split(b'\n')
+            pending = lines.pop()
+            for line in lines:
+                if len(line) > max_line_bytes:
+                    raise TooLarge("ndjson line decompresses to more than %d bytes" % max_line_bytes)
+                yield line + b'\n'
+            if len(pending) > max_line_bytes:
+                raise TooLarge("ndjson line decompresses to more than %d bytes" % max_line_bytes)
+            data = decompressor.more(block_size)
+        if not block:
+            break
+    if pending:
+        yield pending
+
+
+def choose_encoding(accept_encoding):
+    """Returns the encoding (gzip or deflate) to compress a response with, from the Accept-Encoding header, or None"""
+    if not accept_encoding:
+        return None
+    weights = {}
+    for item in accept_encoding.split(','):
+        name, _, params = item.strip().partition(';')
+        weight = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                weight = float(params[2:])
+            except ValueError:
+                weight = 0.0
+        weights[name.strip().lower()] = weight
+    best = None
+    for encoding in ('gzip', 'deflate'):  # gzip first, when both are equally acceptable
+        weight = weights.get(encoding, weights.get('*', 0.0))
+        if weight > 0 and (best is None or weight > best[1]):
+            best = (encoding, weight)
+    return best[0] if best else None
+
+
+def compress(data, encoding):
+    """Compresses a whole response body"""
+    compressor = zlib.compressobj(compression_level, zlib.DEFLATED, WBITS[encoding])
+    return compressor.compress(data) + compressor.flush()
+
+
+def compress_stream(chunks, encoding):
+    """Compresses a streamed response body, flushing after every chunk so the client gets each chunk right away"""
+    compressor = zlib.compressobj(compression_level, zlib.DEFLATED, WBITS[encoding])
+    for chunk in chunks:
+        yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    yield compressor.flush()
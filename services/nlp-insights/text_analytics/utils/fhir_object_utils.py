@@ -1,16 +1,26 @@
 import base64
-import json
+import hashlib
+import os
 
 from fhir.resources.attachment import Attachment
 from fhir.resources.bundle import Bundle
 from fhir.resources.bundle import BundleEntry
 from fhir.resources.bundle import BundleEntryRequest
+from fhir.resources.codeableconcept import CodeableConcept
 from fhir.resources.coding import Coding
 from fhir.resources.extension import Extension
 from fhir.resources.identifier import Identifier
 from fhir.resources.meta import Meta
 from fhir.resources.reference import Reference
+from text_analytics import nlp_metrics
 from text_analytics.insights import insight_constants
+from text_analytics.utils import fast_json
+
+# "inline" puts the NLP output in every insight, "reference" puts it in the first insight of a
+# resource that comes from that output and lets the other insights refer to it by its hash
+EVIDENCE_MODE_INLINE = "inline"
+EVIDENCE_MODE_REFERENCE = "reference"
+evidence_mode = os.getenv("NLP_EVIDENCE_MODE", EVIDENCE_MODE_INLINE)
 
 
 def create_coding(system, code, display=None):
@@ -212,27 +222,61 @@ def create_insight_extension(insight_id_string, insight_system):
     return insight_id_ext
 
 
-def create_insight_detail_extension(nlp_output):
-    nlp_dict = nlp_output # .to_dict()
-    nlp_dict_string = json.dumps(nlp_dict)  # get the string
-    nlp_as_bytes = nlp_dict_string.encode('utf-8')  # convert to bytes including utf8 content
-    nlp_base64_encoded_bytes = base64.b64encode(nlp_as_bytes)  # encode to base64
-    nlp_base64_ascii_string = nlp_base64_encoded_bytes.decode("ascii")  # convert base64 bytes to ascii characters
+def encode_insight_detail(nlp_output, encodings=None):
+    '''
+    Returns the NLP output as base64 encoded json, and the base64 SHA-1 hash of the json that identifies it.
+    encodings is a dict owned by the caller (see PlannedNLPService.evidence_encodings) that keeps the
+    encoding of each NLP output (object) while the caller enhances its resources, so the output is
+    encoded once and shared by all the insights built from it.  Outputs must not be modified once encoded.
+    '''
+    if encodings is None:
+        return _encode_insight_detail(nlp_output)
+    entry = encodings.get(id(nlp_output))
+    if entry is None or entry[0] is not nlp_output:
+        # the entry holds on to the output, so its id() cannot be reused while the caller keeps the dict
+        entry = (nlp_output, _encode_insight_detail(nlp_output))
+        encodings[id(nlp_output)] = entry
+    return entry[1]
+
+
+def _encode_insight_detail(nlp_output):
+    with nlp_metrics.evidence_encode_seconds.time():
+        nlp_as_bytes = fast_json.dumps_bytes(nlp_output)  # json as bytes including utf8 content
+        nlp_base64_ascii_string = base64.b64encode(nlp_as_bytes).decode("ascii")  # encode to base64 ascii characters
+        evidence_hash = base64.b64encode(hashlib.sha1(nlp_as_bytes).digest()).decode("ascii")
+    return nlp_base64_ascii_string, evidence_hash
+
+
+def create_insight_detail_extension(nlp_output, reference=False, encodings=None):
+    '''
+    Creates the evidence detail extension of an insight, holding the NLP output as an attachment
+    (encoded once per output when given the encodings dict of the caller, see encode_insight_detail).
+    In "reference" evidence mode the attachment also gets the hash of the NLP output, and when
+    reference is True (the resource already holds the data for this NLP output) the attachment
+    only has the hash, which refers to the attachment in the resource that has the data.
+    '''
+    nlp_base64_ascii_string, evidence_hash = encode_insight_detail(nlp_output, encodings)
+    nlp_metrics.insights_created.inc()
     insight_detail = Extension.construct()
     insight_detail.url = insight_constants.INSIGHT_EVIDENCE_DETAIL_URL
-    attachment = Attachment.construct()
-    attachment.contentType = "json"
-    attachment.data = nlp_base64_ascii_string  # data is an ascii string of encoded data
-    insight_detail.valueAttachment = attachment
+    attachment_fields = {"contentType": "json"}
+    if evidence_mode == EVIDENCE_MODE_REFERENCE:
+        attachment_fields["hash"] = evidence_hash
+        if not reference:
+            attachment_fields["data"] = nlp_base64_ascii_string
+    else:
+        attachment_fields["data"] = nlp_base64_ascii_string  # data is an ascii string of encoded data
+    # constructed from fields, so the (large) encoded data is not validated again and stays a string
+    insight_detail.valueAttachment = Attachment.construct(**attachment_fields)
     return insight_detail
 
 
 # ACD will often return multiple codes from one system in a comma delimited list
 # Split the list, then create a separate coding system entry for each one
-def create_coding_entries(codeable_concept, code_url, code_ids, insight_id, insight_system):
+def create_coding_entries(codeable_concept, code_url, code_ids, insight_id, insight_system, codings=None):
     ids = code_ids.split(",")
     for id in ids:
-        code_entry = find_codable_concept(codeable_concept, id, code_url)
+        code_entry = find_codable_concept(codeable_concept, id, code_url, codings)
         if code_entry is not None and code_entry.extension is not None and code_entry.extension[
             0].url == insight_constants.INSIGHT_REFERENCE_URL:
             # there is already a derived extension
@@ -241,13 +285,20 @@ def create_coding_entries(codeable_concept, code_url, code_ids, insight_id, insi
             # the Concept exists, but no derived extension
             coding = create_coding_system_entry(code_url, id, insight_id, insight_system)
             codeable_concept.coding.append(coding)
+            _index_coding(codings, coding)
 
 
-def add_codings(concept, codeable_concept, insight_id, insight_system):
+def add_codings(concept, codeable_concept, insight_id, insight_system, codings=None):
+    '''
+    Adds the codes of the concept to the codeable_concept.  codings is the index of the codeable_concept
+    that the caller keeps while it adds insights to it (see index_codings), or None to search its codings.
+    '''
+    if codings is None:
+        codings = index_codings(codeable_concept)
     if 'cui' in concept:
         # For CUIs, we do not handle comma-delimited values (have not seen that we ever have more than one value)
         # We use the preferred name from UMLS for the display text
-        code_entry = find_codable_concept(codeable_concept, concept['cui'], insight_constants.UMLS_URL)
+        code_entry = find_codable_concept(codeable_concept, concept['cui'], insight_constants.UMLS_URL, codings)
         if code_entry is not None and code_entry.extension is not None and code_entry.extension[
             0].url == insight_constants.INSIGHT_REFERENCE_URL:
             # there is already a derived extension
@@ -257,34 +308,38 @@ def add_codings(concept, codeable_concept, insight_id, insight_system):
             coding = create_coding_system_entry(insight_constants.UMLS_URL, concept['cui'], insight_id, insight_system)
             coding.display = concept["preferredName"]
             codeable_concept.coding.append(coding)
+            _index_coding(codings, coding)
     if "snomedConceptId" in concept:
         create_coding_entries(codeable_concept, insight_constants.SNOMED_URL, concept["snomedConceptId"], insight_id,
-                              insight_system)
+                              insight_system, codings)
     if "nciCode" in concept:
         create_coding_entries(codeable_concept, insight_constants.NCI_URL, concept["nciCode"], insight_id,
-                              insight_system)
+                              insight_system, codings)
     if "loincId" in concept:
         create_coding_entries(codeable_concept, insight_constants.LOINC_URL, concept["loincId"], insight_id,
-                              insight_system)
+                              insight_system, codings)
     if "meshId" in concept:
         create_coding_entries(codeable_concept, insight_constants.MESH_URL, concept["meshId"], insight_id,
-                              insight_system)
+                              insight_system, codings)
     if "icd9Code" in concept:
         create_coding_entries(codeable_concept, insight_constants.ICD9_URL, concept["icd9Code"], insight_id,
-                              insight_system)
+                              insight_system, codings)
     if "icd10Code" in concept:
         create_coding_entries(codeable_concept, insight_constants.ICD10_URL, concept["icd10Code"], insight_id,
-                              insight_system)
+                              insight_system, codings)
     if "rxNormId" in concept:
         create_coding_entries(codeable_concept, insight_constants.RXNORM_URL, concept["rxNormId"], insight_id,
-                              insight_system)
+                              insight_system, codings)
 
 
-def add_codings_drug(drug, drug_name, codeable_concept, insight_id, insight_system):
+def add_codings_drug(drug, drug_name, codeable_concept, insight_id, insight_system, codings=None):
+    '''Adds the codes of the drug to the codeable_concept, with the index of its codings as for add_codings'''
+    if codings is None:
+        codings = index_codings(codeable_concept)
     if drug.get("cui") is not None:
         # For CUIs, we do not handle comma-delimited values (have not seen that we ever have more than one value)
         # We use the preferred name from UMLS for the display text
-        code_entry = find_codable_concept(codeable_concept, drug.get("cui"), insight_constants.UMLS_URL)
+        code_entry = find_codable_concept(codeable_concept, drug.get("cui"), insight_constants.UMLS_URL, codings)
         if code_entry is not None and code_entry.extension is not None and code_entry.extension[
             0].url == insight_constants.INSIGHT_REFERENCE_URL:
             # there is already a derived extension
@@ -296,19 +351,41 @@ def add_codings_drug(drug, drug_name, codeable_concept, insight_id, insight_syst
 
             coding.display = drug_name
             codeable_concept.coding.append(coding)
+            _index_coding(codings, coding)
     if drug.get("rxNormID") is not None:
         create_coding_entries(codeable_concept, insight_constants.RXNORM_URL, drug.get("rxNormID"), insight_id,
-                              insight_system)
+                              insight_system, codings)
+
+
 
 
 
+def index_codings(codeable_concept):
+    '''
+    Returns a (system, code) -> entry index of the codings of the codeable_concept, so that an insight
+    builder adding many insights to one CodeableConcept finds codes in O(1): the builder creates the index
+    with the CodeableConcept and passes it to add_codings/add_codings_drug, which index the codings they add.
+    The first entry of a (system, code) wins, as with find_codable_concept.
+    '''
+    codings = {}
+    for entry in getattr(codeable_concept, 'coding', None) or []:  # a template dict has no codings yet
+        _index_coding(codings, entry)
+    return codings
+
+
+def _index_coding(codings, entry):
+    if codings is not None:
+        codings.setdefault((entry.system, entry.code), entry)
 
 
-def find_codable_concept(codeable_concept, id, system):
+def find_codable_concept(codeable_concept, id, system, codings=None):
     '''
-    Looks through the array of the codeable_concept for an entry matching the id and system.
+    Looks through the array of the codeable_concept for an entry matching the id and system, or in the
+    codings index of the codeable_concept when given (see index_codings).
     Returns the entry if found, or None if not found.
     '''
+    if codings is not None:
+        return codings.get((system, id))
     for entry in codeable_concept.coding:
         if entry.system == system and entry.code == id:
             return entry
@@ -358,6 +435,44 @@ def add_medication_confidences(insight_ext, insight_model_data):
                                    insight_model_data['medication']['usage']['labMeasurementScore'])
     insight_ext.append(confidence)
 
+def codeable_concept_from_json(codeable_concept_json):
+    '''
+    Returns a CodeableConcept for a codeable concept (as json object) that the insight builders can
+    add codings to, without validating it.  Only the codings and their extensions are wrapped in
+    models; everything else is kept as the original json.
+    Use update_codeable_concept_json to copy the codings back to the json object.
+    '''
+    codings = None
+    if codeable_concept_json.get('coding') is not None:
+        codings = [Coding.construct(**dict(coding, extension=_extensions_from_json(coding.get('extension'))))
+                   for coding in codeable_concept_json['coding']]
+    return CodeableConcept.construct(**dict(codeable_concept_json, coding=codings))
+
+
+def update_codeable_concept_json(codeable_concept_json, codeable_concept):
+    '''Copies the codings of a CodeableConcept from codeable_concept_from_json back to its json object'''
+    if codeable_concept.coding is not None:
+        codeable_concept_json['coding'] = [coding.dict() for coding in codeable_concept.coding]
+
+
+def meta_from_json(meta_json):
+    '''
+    Returns a Meta for a resource meta (as json object, may be None) that the insight builders can
+    add extensions to, without validating it.  Only the extensions are wrapped in models.
+    An empty Meta is returned when there is no meta, so that the builders never assign one to a
+    resource that was not validated.
+    '''
+    if meta_json is None:
+        return Meta.construct()
+    return Meta.construct(**dict(meta_json, extension=_extensions_from_json(meta_json.get('extension'))))
+
+
+def _extensions_from_json(extensions_json):
+    if extensions_json is None:
+        return None
+    return [Extension.construct(**extension) for extension in extensions_json]
+
+
 def get_diagnostic_report_data(diagnostic_report):
     '''
     Returns the attached document as a string, decoded.
@@ -371,6 +486,16 @@ def get_diagnostic_report_data(diagnostic_report):
         return text
     return None
 
+def decode_attachment_data(attachment_json):
+    '''
+    Returns the data of an attachment (as json object) as a string, decoded.
+    Returns None if there is no attachment or it has no data.
+    '''
+    if attachment_json and attachment_json.get('data'):
+        byte_text = base64.b64decode(attachment_json['data'])
+        return byte_text.decode('utf8')
+    return None
+
 def get_document_reference_data(document_reference):
     '''
     Returns the attached document as a string, decoded.